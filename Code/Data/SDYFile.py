@@ -1,8 +1,13 @@
-from math import sqrt
+import os
+from datetime import datetime, timedelta
+
 import numpy as np
 import pandas as pd
-import peakutils
-import scipy.signal as signal
+
+from Code.Data import cache
+from Code.Data.clip import SIGNAL_DTYPE, clip_threshold, clip_fill, forward_fill
+from Code.Data.peaks import BeatIndex, detect_peaks, DEFAULT_METHOD as PEAK_METHOD
+from Code.Data.timeindex import SampleClock
 
 DEMOGRAPHICS = ["SURNAME", "FIRSTNAME", "MIDDLENAME", "SEX", "MRN", "CONSULTANT", "DOB", "PROCEDURE", "PROCEDURE_ID",
                 "ACCESSION_NUMBER", "FFR", "FFR SUID", "REFERRING PHYSICIAN", "PATIENT HISTORY", "IVUS SUID",
@@ -13,6 +18,7 @@ EXAM_TYPES = {3: 'Pressure',
               5: 'Combo'}
 
 N_CHANNELS = 1123
+HEADER_BYTES = 4 + 8 + 4 + len(DEMOGRAPHICS) * 512  # filetype, datetime, examtype, then 512 bytes per demographic
 
 COLS = {'pd': (5, 7, 9, 11),
         'pa_trans': (12, 13, 14, 15),
@@ -23,130 +29,304 @@ COLS = {'pd': (5, 7, 9, 11),
         'calc2': (36, 36, 37, 37),
         'calc3': (38, 38, 39, 39)}
 
+DF_COLUMNS = ('pa', 'pd', 'flow', 'ecg', 'calc1', 'calc2', 'calc3', 'time')
+BEAT_CHANNELS = ('pd', 'pa')  # Beat indexes built (and cached) on load - Pd for the beat-wise plots, Pa for ensembles
+
 SAMPLING_FREQ = 200
 EXPECTED_SAMPLING_INTERVAL_MAX = int(SAMPLING_FREQ/2)
 
+FILETIME_EPOCH = datetime(1601, 1, 1)  # The header's datetime is a Windows FILETIME - 100 ns intervals since this
+FILETIME_YEARS = (1990, 2100)  # Anything outside these isn't a real recording date
+
+
+def filetime_to_datetime(filetime):
+    """The header's datetime (the low & high uint32s of a FILETIME) as a datetime, or None if it isn't plausible"""
+    low, high = (int(part) for part in filetime)
+    try:
+        start = FILETIME_EPOCH + timedelta(microseconds=((high << 32) | low) // 10)
+    except OverflowError:
+        return None
+    return start if FILETIME_YEARS[0] <= start.year < FILETIME_YEARS[1] else None
+
+
+class LazyChannelFrame:
+    """Stands in for the DataFrame TxtFile provides, but a column is only decoded the first time it is looked up"""
+
+    def __init__(self, sdyfile):
+        self.sdyfile = sdyfile
+
+    @property
+    def columns(self):
+        return list(DF_COLUMNS)
+
+    def keys(self):
+        return self.columns
+
+    def __contains__(self, column):
+        return column in DF_COLUMNS
+
+    def __iter__(self):
+        return iter(DF_COLUMNS)
+
+    def __len__(self):
+        return self.sdyfile.n_samples
+
+    def __getitem__(self, column):
+        if column not in DF_COLUMNS:
+            raise KeyError(column)
+        return pd.Series(self.sdyfile.get_channel(column), name=column, copy=False)
+
 
 class SDYFile:
     """Thanks to Matt Shun-Shin for figuring out the fields"""
 
-    def __init__(self, filepath, pa_channel='pa_physio', clip_wave_quantile=0.9, clip_wave_n_quantiles=1.5):
+    def __init__(self, filepath, pa_channel='pa_physio', clip_wave_quantile=0.9, clip_wave_n_quantiles=1.5,
+                 memmap=True, use_cache=True):
         self.studypath = filepath
-        self.pa_channel = pa_channel
+        self.channels = {}  # Decoded channels, filled on first access by get_channel()
+        self.beat_indexes = {}  # Channel name -> BeatIndex, filled on first access by beat_index()
+        self._pa_channel = pa_channel
+        self.memmap = memmap  # If True, raw_study_data is a read-only np.memmap rather than loaded into RAM
+        self.use_cache = use_cache  # If True, decoded channels & peaks are kept in a sidecar cache (see cache.py)
+        self.cached_channels = set()  # Channels already in the sidecar cache
         self.clip_wave_quantile = clip_wave_quantile
         self.clip_wave_n_quantiles = clip_wave_n_quantiles
         self.filetype, self.datetime, self.examtype, self.demographics = None, None, None, None
         self.patient_id, self.study_date, self.export_date = None, None, None  # To mimic TxtFile
         self.raw_study_data = None
-        self.pd, self.pa, self.ecg, self.flow, self.df = None, None, None, None, None
-        self.calc1, self.calc2, self.calc3 = None, None, None
+        self.clock = None  # SampleClock - the time axis, without storing it
+        self.df = LazyChannelFrame(self)
 
         self.parse_data()
-        self.peaks = self.find_peaks()
+        if not (self.use_cache and self.load_cache()):
+            for channel_name in BEAT_CHANNELS:
+                self.beat_index(channel_name)  # Which caches Pd & Pa once both are done
         print(f"Found {len(self.peaks)}: {self.peaks}")
 
+    @property
+    def pa_channel(self):
+        return self._pa_channel
+
+    @pa_channel.setter
+    def pa_channel(self, pa_channel):
+        """Swapping the Pa channel only needs Pa to be decoded again"""
+        if pa_channel != self._pa_channel:
+            self.channels.pop('pa', None)
+            self.beat_indexes.pop('pa', None)
+            self.cached_channels = set()  # The cache is keyed on the Pa channel
+        self._pa_channel = pa_channel
+
+    @property
+    def peaks(self):
+        return self.beat_index('pd').peaks
+
+    def beat_index(self, channel_name='pd'):
+        if channel_name not in self.beat_indexes:
+            self.beat_indexes[channel_name] = BeatIndex(self.find_peaks(channel_name), trace=self.channel(channel_name),
+                                                        min_dist=EXPECTED_SAMPLING_INTERVAL_MAX)
+            self.update_cache()
+        return self.beat_indexes[channel_name]
+
+    def channel(self, channel_name):
+        """A read-only view of a decoded channel (which is contiguous, and decoded just once) - cheaper than going via
+        .df, as nothing is copied"""
+        view = self.get_channel(channel_name).view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def time(self):
+        """Indexes like the time column, but the time stamps are only computed for the samples asked for"""
+        return self.clock
+
+    @property
+    def time_index(self):
+        return self.clock
+
+    @property
+    def start_datetime(self):
+        return self.clock.start
+
+    @property
+    def pd(self):
+        return self.get_channel('pd')
+
+    @property
+    def pa(self):
+        return self.get_channel('pa')
+
+    @property
+    def ecg(self):
+        return self.get_channel('ecg')
+
+    @property
+    def flow(self):
+        return self.get_channel('flow')
+
+    @property
+    def calc1(self):
+        return self.get_channel('calc1')
+
+    @property
+    def calc2(self):
+        return self.get_channel('calc2')
+
+    @property
+    def calc3(self):
+        return self.get_channel('calc3')
+
+    @property
+    def n_samples(self):
+        return len(self.raw_study_data) * len(COLS['pd'])
+
     def parse_data(self):
         with open(self.studypath, 'rb') as f:
             self.load_study_info(f)
             self.parse_study_data(f)
 
     def load_study_info(self, file):
-        self.filetype = np.fromfile(file, dtype=np.uint32, count=1)[0]
-        self.datetime = np.fromfile(file, dtype=np.uint32, count=2)
-        self.examtype = np.fromfile(file, dtype=np.int32, count=1)[0]
+        study_info = self.read_study_info(file)
+        self.filetype = study_info['filetype']
+        self.datetime = study_info['datetime']
+        self.examtype = study_info['examtype']
+        self.demographics = study_info['demographics']
+        self.patient_id = study_info['patient_id']
+        self.study_date = study_info['study_date']
+        self.export_date = study_info['export_date']
+
+    @staticmethod
+    def read_study_info(file):
+        """Parses the fixed-size header from an open file, leaving it positioned at the start of the sample data"""
+        header = file.read(HEADER_BYTES)
+        if len(header) < HEADER_BYTES:
+            raise ValueError(f"File too short to contain an SDY header ({len(header)} bytes)")
+        filetype = np.frombuffer(header, dtype=np.uint32, count=1, offset=0)[0]
+        datetime = np.frombuffer(header, dtype=np.uint32, count=2, offset=4).copy()
+        examtype = np.frombuffer(header, dtype=np.int32, count=1, offset=12)[0]
         demographics = {}
-        for demographic_name in DEMOGRAPHICS:
-            demographics[demographic_name] = file.read(512).decode('utf-16').replace('\x00', '').strip()
-        self.demographics = demographics
-        self.patient_id = demographics['MRN']
-        self.study_date = self.datetime
-        self.export_date = "NA (SDY file)"
+        for i_demographic, demographic_name in enumerate(DEMOGRAPHICS):
+            start = 16 + i_demographic * 512
+            demographics[demographic_name] = header[start:start + 512].decode('utf-16').replace('\x00', '').strip()
+        return {'filetype': filetype,
+                'datetime': datetime,
+                'examtype': examtype,
+                'demographics': demographics,
+                'patient_id': demographics['MRN'],
+                'study_date': datetime,
+                'export_date': "NA (SDY file)"}
+
+    @staticmethod
+    def read_header(filepath):
+        """Metadata only - reads the demographics header without touching the waveform data"""
+        with open(filepath, 'rb') as f:
+            return SDYFile.read_study_info(f)
 
     def parse_study_data(self, file):
         """Should start in correct place following self.load_study_info()"""
-        raw_study_data = np.fromfile(file, dtype=np.uint16, count=-1)
-        recording_duration = len(raw_study_data) // N_CHANNELS
-        raw_study_data = raw_study_data.reshape((recording_duration, N_CHANNELS))
-        self.raw_study_data = raw_study_data
-        self.pd = self.clip_wave(raw_study_data[:, COLS['pd']].ravel(), quantile=self.clip_wave_quantile, n_quantiles=self.clip_wave_n_quantiles)
-        self.pa = self.clip_wave(raw_study_data[:, COLS[self.pa_channel]].ravel(), quantile=self.clip_wave_quantile, n_quantiles=self.clip_wave_n_quantiles, ref_wave=self.pd)
-        self.ecg = raw_study_data[:, COLS['ecg']].ravel()
-        self.flow = raw_study_data[:, COLS['flow']].ravel()
-        self.calc1 = raw_study_data[:, COLS['calc1']].ravel()
-        self.calc2 = raw_study_data[:, COLS['calc2']].ravel()
-        self.calc3 = raw_study_data[:, COLS['calc3']].ravel()
-        self.create_dataframe()
+        if self.memmap:
+            self.raw_study_data = self.map_study_data(self.studypath, offset=file.tell())
+        else:
+            raw_study_data = np.fromfile(file, dtype=np.uint16, count=-1)
+            recording_duration = len(raw_study_data) // N_CHANNELS
+            self.raw_study_data = raw_study_data.reshape((recording_duration, N_CHANNELS))
+        self.channels = {}
+        self.clock = SampleClock(self.n_samples, SAMPLING_FREQ, start=filetime_to_datetime(self.datetime),
+                                 samples_per_row=len(COLS['pd']))
+
+    @staticmethod
+    def map_study_data(filepath, offset=HEADER_BYTES):
+        """Maps the samples following the demographics header as a read-only (n_samples, N_CHANNELS) array without
+        reading them; pages are only pulled in by the OS when a channel is actually sliced out.
+        Any trailing partial row is ignored."""
+        n_samples = (os.path.getsize(filepath) - offset) // (N_CHANNELS * np.dtype(np.uint16).itemsize)
+        if n_samples <= 0:  # np.memmap refuses to map an empty region
+            return np.zeros((0, N_CHANNELS), dtype=np.uint16)
+        return np.memmap(filepath, dtype=np.uint16, mode='r', offset=offset, shape=(n_samples, N_CHANNELS))
+
+    def read_channel(self, channel_name, dtype=np.uint16):
+        """Pulls the sub-sample columns for one channel (see COLS) into RAM as a flat array of dtype, converting each
+        column straight from the file's rows - so there's no intermediate copy"""
+        cols = COLS[channel_name]
+        channel = np.empty((len(self.raw_study_data), len(cols)), dtype=dtype)
+        for i_col, col in enumerate(cols):
+            channel[:, i_col] = self.raw_study_data[:, col]
+        return channel.ravel()
+
+    def get_channel(self, channel_name):
+        if channel_name not in self.channels:
+            self.channels[channel_name] = self.decode_channel(channel_name)
+            self.update_cache()
+        return self.channels[channel_name]
+
+    def decode_channel(self, channel_name):
+        """Pressures are clipped (Pa against Pd's thresholds) in place; everything else is just converted to float32"""
+        if channel_name == 'pd':
+            wave = self.read_channel('pd', dtype=SIGNAL_DTYPE)
+            return clip_fill(wave, clip_threshold(wave, self.clip_wave_quantile, self.clip_wave_n_quantiles))
+        elif channel_name == 'pa':
+            wave = self.read_channel(self.pa_channel, dtype=SIGNAL_DTYPE)
+            return clip_fill(wave, clip_threshold(self.pd, self.clip_wave_quantile, self.clip_wave_n_quantiles))
+        elif channel_name == 'time':  # Only ever materialised for .df - everything else indexes the clock
+            return np.asarray(self.clock)
+        elif channel_name in COLS:
+            return self.read_channel(channel_name, dtype=SIGNAL_DTYPE)
+        else:
+            raise KeyError(f"Unknown channel {channel_name}")
+
+    def cache_key(self):
+        return cache.cache_key(self.studypath, pa_channel=self.pa_channel, clip_wave_quantile=self.clip_wave_quantile,
+                               clip_wave_n_quantiles=self.clip_wave_n_quantiles, peak_method=PEAK_METHOD)
+
+    def load_cache(self):
+        """Returns True if the channels and peaks could be served from a valid cache"""
+        arrays = cache.load_cache(self.studypath, self.cache_key())
+        if arrays is None:
+            return False
+        peaks = {channel_name: arrays.pop(f"peaks_{channel_name}") for channel_name in BEAT_CHANNELS}
+        self.channels.update(arrays)
+        self.cached_channels = set(arrays)
+        for channel_name in BEAT_CHANNELS:
+            self.beat_indexes[channel_name] = BeatIndex(peaks[channel_name], trace=self.channel(channel_name),
+                                                        min_dist=EXPECTED_SAMPLING_INTERVAL_MAX)
+        return True
+
+    def update_cache(self):
+        """Once Pd & Pa have their beat indexes, (re)writes the cache whenever a channel has been decoded that isn't in
+        it yet - so only channels something has actually used are decoded, and each is only decoded once"""
+        if not self.use_cache or any(channel_name not in self.beat_indexes for channel_name in BEAT_CHANNELS):
+            return
+        if not set(self.channels) - {'time'} - self.cached_channels:
+            return
+        self.save_cache()
+
+    def save_cache(self):
+        """Caches the channels decoded so far (bar the time axis, which isn't stored) and the beat indexes"""
+        arrays = {column: channel for column, channel in self.channels.items() if column != 'time'}
+        for channel_name in BEAT_CHANNELS:
+            arrays[f"peaks_{channel_name}"] = self.beat_index(channel_name).peaks
+        if cache.save_cache(self.studypath, self.cache_key(), arrays):
+            self.cached_channels = set(arrays) - {f"peaks_{channel_name}" for channel_name in BEAT_CHANNELS}
 
     def create_dataframe(self):
-        """Used by Cophy, in similar format to TxtFile"""
-        df = {'pa': np.array(self.pa),
-              'pd': np.array(self.pd),
-              'flow': np.array(self.flow),
-              'ecg': np.array(self.ecg),
-              'calc1': np.array(self.calc1),
-              'calc2': np.array(self.calc2),
-              'calc3': np.array(self.calc3),
-              'time': np.linspace(0, len(self.pa) // SAMPLING_FREQ, len(self.pa))}
-        self.df = pd.DataFrame.from_dict(df).astype(np.float)
+        """Decodes every channel into a real DataFrame, in similar format to TxtFile"""
+        return pd.DataFrame({column: self.get_channel(column) for column in DF_COLUMNS}, copy=False)
 
     @staticmethod
     def clip_wave(wave, quantile, n_quantiles, ref_wave=None):
-        wave = np.array(wave, dtype=np.float)
+        """A clipped & forward-filled float32 copy of wave (see clip.py; decode_channel() clips in place instead)"""
+        wave = np.array(wave, dtype=SIGNAL_DTYPE)
         if ref_wave is None:
             ref_wave = wave
-        quantile = np.nanquantile(ref_wave, quantile)
-        median = np.nanmedian(ref_wave)
-        wave[wave > median + (n_quantiles * quantile)] = np.nan
-        wave = SDYFile.numpy_fill(wave)  # Switch nans with preceding values, makes things easier
-        return wave
+        return clip_fill(wave, clip_threshold(ref_wave, quantile, n_quantiles))
 
     @staticmethod
     def numpy_fill(arr):
-        '''Solution provided by Divakar. -  see https://stackoverflow.com/q/41190852'''
-        arr = np.expand_dims(arr, 0)
-        mask = np.isnan(arr)
-        idx = np.where(~mask, np.arange(mask.shape[1]), 0)
-        np.maximum.accumulate(idx, axis=1, out=idx)
-        out = arr[np.arange(idx.shape[0])[:, None], idx]
-        return out[0]
-
-    def find_peaks(self, trace_name='pd'):
-        def tony_detect_peaks(signal, threshold=0.5):
-            """
-            https://github.com/MonsieurV/py-findpeaks/blob/master/tests/libs/tony_beltramelli_detect_peaks.py
-            Performs peak detection on three steps: root mean square, peak to
-            average ratios and first order logic.
-            threshold used to discard peaks too small """
-            # compute root mean square
-            root_mean_square = sqrt(np.sum(np.square(signal) / len(signal)))
-            # compute peak to average ratios
-            ratios = np.array([pow(x / root_mean_square, 2) for x in signal])
-            # apply first order logic
-            peaks = (ratios > np.roll(ratios, 1)) & (ratios > np.roll(ratios, -1)) & (ratios > threshold)
-            # optional: return peak indices
-            peak_indexes = []
-            for i in range(0, len(peaks)):
-                if peaks[i]:
-                    peak_indexes.append(i)
-            return peak_indexes
-
-        PEAKMETHOD = 'peakutils'
-        trace = np.array(self.df[trace_name])
-
-        if PEAKMETHOD == 'peakutils':
-            print(f"In finding peaks, trace is\n{trace}, max of {max(trace)}, min dist of {EXPECTED_SAMPLING_INTERVAL_MAX}")
-            peaks = peakutils.indexes(trace, min_dist=int(EXPECTED_SAMPLING_INTERVAL_MAX))
-            print(f"Got {len(peaks)} peaks: {peaks}")
-        elif PEAKMETHOD == 'cwt':
-            widths = [int(w) for w in np.linspace(EXPECTED_SAMPLING_INTERVAL_MAX, int(EXPECTED_SAMPLING_INTERVAL_MAX*4), 4)]
-            print(f'widths are {widths}')
-            peaks = signal.find_peaks_cwt(trace, widths=widths)
-        elif PEAKMETHOD == 'tony':
-            peaks = tony_detect_peaks(trace)
-        else:
-            raise ValueError()
+        """A copy of arr with NaNs replaced by the preceding value"""
+        return forward_fill(np.array(arr, dtype=np.float64))
 
-        return peaks
+    def find_peaks(self, trace_name='pd', method=PEAK_METHOD):
+        """Detects the peaks afresh - beat_index() (or .peaks) has them already"""
+        return detect_peaks(self.get_channel(trace_name), method=method, min_dist=EXPECTED_SAMPLING_INTERVAL_MAX)
 
     def __repr__(self):
         try:
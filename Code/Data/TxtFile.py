@@ -3,38 +3,146 @@ import re
 import numpy as np
 import pandas as pd
 
+from Code.Data import cache
+from Code.Data.peaks import BeatIndex, DEFAULT_METHOD as PEAK_METHOD
+from Code.Data.timeindex import TimeIndex
+
+TIME_DTYPE = np.float64
+SIGNAL_DTYPE = np.float32  # Plenty for mmHg & cm/s, and half the memory of float64
+BEAT_CHANNELS = ('pd', 'pa')  # Beat indexes built (and cached) on load, as for SDYFile
+
 
 class TxtFile:
-    def __init__(self, studypath, pd_offset=None):
+    def __init__(self, studypath, pd_offset=None, use_cache=True):
         self.studypath = studypath
         self.pd_offset = pd_offset
+        self.use_cache = use_cache  # If True, the parsed columns are kept in a sidecar cache (see cache.py)
         self.patient_id = None
         self.study_date = None
         self.export_date = None
         self.df = None
+        self.channels = {}  # Contiguous arrays of the df columns, filled on first access by channel()
+        self._time_index = None  # TimeIndex of the time column, made on first access by time_index
+        self.beat_indexes = {}  # Channel name -> BeatIndex, filled on first access by beat_index()
         self.load_data()
 
-    def load_data(self):
-        """The heading columns are so variable it's almost unbelievable... And sometimes the RWave and Timestamp columns
-        are reversed in order! Easiest is just to test for all the possibilities and hard code it (ugh)
+    def channel(self, channel_name):
+        """A read-only view of a column of df - contiguous, and only ever copied from df (if at all) once"""
+        if channel_name not in self.channels:
+            self.channels[channel_name] = np.ascontiguousarray(self.df[channel_name].to_numpy())
+        view = self.channels[channel_name].view()
+        view.flags.writeable = False
+        return view
+
+    @property
+    def time(self):
+        return self.channel('time')
+
+    @property
+    def time_index(self):
+        """Time <-> sample mapping - O(1) unless the export's timestamps are irregular"""
+        if self._time_index is None:
+            self._time_index = TimeIndex(self.time)
+        return self._time_index
+
+    @property
+    def peaks(self):
+        return self.beat_index('pd').peaks
 
-        Returns a dataframe."""
+    def beat_index(self, channel_name='pd'):
+        if channel_name not in self.beat_indexes:
+            self.beat_indexes[channel_name] = BeatIndex.from_trace(self.channel(channel_name))
+        return self.beat_indexes[channel_name]
+
+    def load_data(self):
+        """Returns a dataframe."""
+        header = self.read_header(self.studypath)
+        self.patient_id = header['patient_id']
+        self.study_date = header['study_date']
+        self.export_date = header['export_date']
+        if self.use_cache:
+            arrays = cache.load_cache(self.studypath, self.cache_key())
+            if arrays is not None:
+                peaks = {channel_name: arrays.pop(f"peaks_{channel_name}") for channel_name in BEAT_CHANNELS}
+                self.df = pd.DataFrame(arrays, copy=False)
+                for channel_name in BEAT_CHANNELS:
+                    self.beat_indexes[channel_name] = BeatIndex(peaks[channel_name], trace=self.channel(channel_name))
+                return
+        heading_line_number, names, numeric_cols = header['heading_line_number'], header['names'], header['numeric_cols']
+        # Only the numeric columns are parsed - 'rwave' (and the timestamps after it) are full of crap and never used
+        numeric_names = names[:numeric_cols]
+        dtypes = {name: TIME_DTYPE if name == 'time' else SIGNAL_DTYPE for name in numeric_names}
         with open(self.studypath) as f:
-            """First find the row with the RWave in it; this is our column headings"""
-            lines = f.readlines()
-            self.patient_id = re.search("Patient: ([A-Za-z0-9]*),", lines[0])
-            self.patient_id = self.patient_id.group(1) if self.patient_id else "?"
-            self.study_date = re.search("Study date: ([0-9/]*),", lines[0])
-            self.study_date = self.study_date.group(1) if self.study_date else "?"
-            self.export_date = re.search("Export date: ([0-9/]*)", lines[0])
-            self.export_date = self.export_date.group(1) if self.export_date else "?"
-            for i_line, line in enumerate(lines):
+            for _ in range(heading_line_number + 1):
+                f.readline()
+            data_start = f.tell()
+            decimal = self.sniff_decimal(f, numeric_cols)
+            f.seek(data_start)
+            df = pd.read_csv(f, sep='\t', header=None, names=names, usecols=numeric_names, dtype=dtypes,
+                             decimal=decimal, index_col=False)
+
+        if self.pd_offset:
+            pd_wave = df['pd'].to_numpy()
+            new_pd = np.concatenate((pd_wave[self.pd_offset:], np.zeros(self.pd_offset, dtype=pd_wave.dtype)))
+            df['pd'] = new_pd
+            # new_flow = np.concatenate((np.array(df.flow[self.pd_offset:]), np.zeros(self.pd_offset)))
+            # df.flow = new_flow
+
+        self.df = df
+        if self.use_cache:
+            arrays = {column: self.channel(column) for column in df.columns}
+            for channel_name in BEAT_CHANNELS:
+                arrays[f"peaks_{channel_name}"] = self.beat_index(channel_name).peaks
+            cache.save_cache(self.studypath, self.cache_key(), arrays)
+
+    def cache_key(self):
+        return cache.cache_key(self.studypath, pd_offset=self.pd_offset, peak_method=PEAK_METHOD)
+
+    @staticmethod
+    def sniff_decimal(f, numeric_cols):
+        """Some exports use decimal commas; the columns are tab separated so a comma in a numeric column can only be a
+        decimal point. Reads data lines from f until one has a decimal separator in it - rows of whole numbers (e.g.
+        at time 0) don't say which it is."""
+        for data_line in f:
+            numeric_fields = data_line.split('\t')[:numeric_cols]
+            if any(',' in field for field in numeric_fields):
+                return ','
+            if any('.' in field for field in numeric_fields):
+                return '.'
+        return '.'
+
+    @staticmethod
+    def read_header(studypath):
+        """Metadata only - reads the first line and up to the heading row, without parsing any of the data."""
+        with open(studypath) as f:
+            first_line = f.readline()
+            patient_id = re.search("Patient: ([A-Za-z0-9]*),", first_line)
+            study_date = re.search("Study date: ([0-9/]*),", first_line)
+            export_date = re.search("Export date: ([0-9/]*)", first_line)
+            """Then find the row with the RWave in it; this is our column headings"""
+            line, heading_line_number = first_line, 0
+            while line:
                 if "RWave" in line:
-                    heading_line = line
-                    heading_line_number = i_line
                     break
-            else:  # If didn't break
+                line = f.readline()
+                heading_line_number += 1
+            else:  # Hit EOF without breaking
                 raise ValueError("Failed to find heading row")
+        names, numeric_cols = TxtFile.column_layout(line, studypath)
+        return {'patient_id': patient_id.group(1) if patient_id else "?",
+                'study_date': study_date.group(1) if study_date else "?",
+                'export_date': export_date.group(1) if export_date else "?",
+                'heading_line': line,
+                'heading_line_number': heading_line_number,
+                'names': names,
+                'numeric_cols': numeric_cols}
+
+    @staticmethod
+    def column_layout(heading_line, studypath=None):
+        """The heading columns are so variable it's almost unbelievable... And sometimes the RWave and Timestamp columns
+        are reversed in order! Easiest is just to test for all the possibilities and hard code it (ugh)
+
+        Returns the column names and how many of the leading columns are numeric."""
         if heading_line == "Time	Pa	Pd	ECG	IPV	Pv	RWave	Tm\n":
             names = ['time', 'pa', 'pd', 'ecg', 'flow', 'pv', 'rwave', 'timestamp']
             numeric_cols = 5
@@ -45,17 +153,5 @@ class TxtFile:
             names = ['time', 'pa', 'pd', 'ecg', 'flow', 'pv', 'rwave']
             numeric_cols = 5
         else:
-            raise AttributeError(f"Unable to process data format {heading_line} in file {self.studypath}")
-        df = pd.read_csv(self.studypath, skiprows=heading_line_number + 1, sep='\t', header=None,
-                         names=names, dtype=np.object_, index_col=False)
-        df = df.stack().str.replace(',', '.').unstack()
-        # Don't try to convert the 'rwave' column to numeric, it's full of crap
-        df.iloc[:, 0:numeric_cols] = df.iloc[:, 0:numeric_cols].apply(pd.to_numeric)
-
-        if self.pd_offset:
-            new_pd = np.concatenate((np.array(df.pd[self.pd_offset:]), np.zeros(self.pd_offset)))
-            df.pd = new_pd
-            # new_flow = np.concatenate((np.array(df.flow[self.pd_offset:]), np.zeros(self.pd_offset)))
-            # df.flow = new_flow
-
-        self.df = df
+            raise AttributeError(f"Unable to process data format {heading_line} in file {studypath}")
+        return names, numeric_cols
@@ -0,0 +1,81 @@
+"""GUI-free analysis of a study - the same ensembles and metrics LabelUI shows, from a study object and a plain label
+record, so indices can be computed without Qt (e.g. in batch jobs).
+
+A label record is a dict in the format LabelUI saves (see labelstore.py), any of whose keys may be missing:
+    {'pa': True,                              # SDY only: True for the physio Pa channel, False for the transducer
+     'range_rest': (from_s, to_s), 'range_hyp': (from_s, to_s),
+     'notch_rest': s, 'enddiastole_rest': s,  # Marker positions within the ensemble beat, in seconds
+     'notch_hyp': s, 'enddiastole_hyp': s}"""
+
+import os
+
+from Code.Data import metrics
+from Code.Data.calculations import build_ensemble
+from Code.Data.TxtFile import TxtFile
+from Code.Data.SDYFile import SDYFile
+
+SAMPLE_FREQ = 200
+PD_OFFSET_TIME = 0.05
+PD_OFFSET_POINT = int(PD_OFFSET_TIME * SAMPLE_FREQ)
+STUDY_EXTENSIONS = ('.txt', '.sdy')
+STATES = ('rest', 'hyp')
+
+
+def pa_channel_from_labels(labels):
+    return 'pa_physio' if labels.get('pa', True) else 'pa_trans'
+
+
+def load_study(studypath, labels=None):
+    """Opens a .txt or .sdy study the way LabelUI does (with the Pa channel from the labels, for SDY files)"""
+    extension = os.path.splitext(studypath)[-1].lower()
+    if extension == '.txt':
+        return TxtFile(studypath=studypath, pd_offset=PD_OFFSET_POINT)
+    elif extension == '.sdy':
+        return SDYFile(filepath=studypath, pa_channel=pa_channel_from_labels(labels or {}))
+    else:
+        raise ValueError(f"Unknown study type {extension} for {studypath}, expected one of {STUDY_EXTENSIONS}")
+
+
+def count_labels(labels):
+    """Number of labels placed, not counting the Pa channel choice"""
+    return len([key for key in labels if key != 'pa'])
+
+
+def build_ensembles(study, labels, previous=None, max_beats=10):
+    """Returns {'rest': Ensemble, 'hyp': Ensemble}, with their markers set if both have been placed. Ensembles in
+    previous (a dict like the one returned) are reused if their study and region are unchanged."""
+    previous = previous or {}
+    ensembles = {}
+    for state in STATES:
+        ensemble = build_ensemble(study, labels.get(f"range_{state}"), previous=previous.get(state),
+                                  max_beats=max_beats)
+        if labels.get(f"range_{state}") is not None:
+            ensemble.set_markers(labels.get(f"notch_{state}"), labels.get(f"enddiastole_{state}"))
+        else:
+            ensemble.set_markers(None, None)
+        ensembles[state] = ensemble
+    return ensembles
+
+
+def analyse(study, labels, max_beats=10):
+    """Returns every available metric, as {group: [{'name', ('state'), ('phase'), 'value'}, ...]}"""
+    return metrics.evaluate(build_ensembles(study, labels, max_beats=max_beats))
+
+
+def column_name(calculation):
+    """e.g. 'WC Pa_rest_mean', 'CFR_peak' or 'FFR'"""
+    return "_".join(str(calculation[key]) for key in ('name', 'state', 'phase') if calculation.get(key) is not None)
+
+
+def flatten_calculations(calculations):
+    """One {column: value} dict, with a column per calculation"""
+    row = {}
+    for group in metrics.GROUPS:
+        for calculation in calculations.get(group, []):
+            row[column_name(calculation)] = calculation['value']
+    return row
+
+
+def metric_columns():
+    """Every column flatten_calculations() can produce, in registry order"""
+    return [column_name(m._asdict()) for m in metrics.METRICS]
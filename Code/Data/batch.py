@@ -0,0 +1,235 @@
+"""Batch export - finds every .txt/.sdy study under a folder, analyses each with its saved labels in a pool of worker
+processes, and streams one row per study into a single CSV (or Parquet, if pyarrow is installed) file.
+
+A study that fails to load or analyse still gets a row, with the reason in the 'error' column.
+
+Nothing here imports Qt, so it can also be run headless, e.g.
+    python -m Code.Data.batch "Data/**/*.sdy" Data/txt_studies --workers 8 --output results.csv"""
+
+import os
+import sys
+import csv
+import glob
+import json
+import math
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from Code.Data import analysis, metrics
+from Code.Data.labelstore import load_labels
+
+INFO_COLUMNS = ['path', 'patient_id', 'study_date', 'export_date', 'n_labels', 'n_beats_rest', 'n_beats_hyp']
+PARQUET_ROWS_PER_GROUP = 256
+
+
+def export_columns():
+    return INFO_COLUMNS + analysis.metric_columns() + ['error']
+
+
+def find_studies(folder, recursive=True):
+    """Sorted paths of every study in folder (and, if recursive, its subfolders)"""
+    studypaths = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for filename in filenames:
+            if os.path.splitext(filename)[-1].lower() in analysis.STUDY_EXTENSIONS:
+                studypaths.append(os.path.join(dirpath, filename))
+        if not recursive:
+            break
+    return sorted(studypaths)
+
+
+def process_study(studypath):
+    """Loads & analyses one study with its saved labels, returning its export row. Never raises, so one bad file
+    doesn't stop a batch"""
+    row = {'path': studypath, 'error': ''}
+    try:
+        labels = load_labels(studypath, read_only=True)  # Other workers may have the same store open
+        study = analysis.load_study(studypath, labels)
+        ensembles = analysis.build_ensembles(study, labels)
+        row.update({'patient_id': study.patient_id,
+                    'study_date': str(study.study_date),
+                    'export_date': study.export_date,
+                    'n_labels': analysis.count_labels(labels),
+                    'n_beats_rest': len(ensembles['rest']),
+                    'n_beats_hyp': len(ensembles['hyp'])})
+        row.update({column: float(value) for column, value in
+                    analysis.flatten_calculations(metrics.evaluate(ensembles)).items()})
+    except Exception as e:
+        row['error'] = f"{type(e).__name__}: {e}"
+        traceback.print_exc()
+    return row
+
+
+def iter_rows(studypaths, workers=None):
+    """Yields export rows as the workers finish them (so not necessarily in the order of studypaths). With workers=1
+    everything runs in this process."""
+    if workers == 1:
+        for studypath in studypaths:
+            yield process_study(studypath)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_study, studypath) for studypath in studypaths]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class CsvRowWriter:
+    def __init__(self, out_path, columns):
+        self.file = open(out_path, 'w', newline='')
+        self.writer = csv.DictWriter(self.file, fieldnames=columns, restval='', extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def json_value(value):
+    """NaN & infinite metrics (e.g. a ratio with nothing to divide by) as null - json would write them as NaN/Infinity,
+    which isn't JSON"""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+
+class JsonRowWriter:
+    """Writes a JSON array of rows, one row per line, so a partial file is still easy to recover"""
+
+    def __init__(self, out_path, columns):
+        self.file = open(out_path, 'w')
+        self.columns = columns
+        self.n_rows = 0
+        self.file.write("[")
+
+    def write(self, row):
+        self.file.write(",\n" if self.n_rows else "\n")
+        json.dump({column: json_value(row[column]) for column in self.columns if column in row}, self.file,
+                  allow_nan=False)
+        self.file.flush()
+        self.n_rows += 1
+
+    def close(self):
+        self.file.write("\n]\n")
+        self.file.close()
+
+
+class ParquetRowWriter:
+    """Buffers rows into row groups, as Parquet can't be appended a row at a time"""
+
+    def __init__(self, out_path, columns):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Exporting to Parquet needs pyarrow - pip install pyarrow, or export to .csv instead")
+        self.pa = pa
+        self.columns = columns
+        string_columns = ('path', 'patient_id', 'study_date', 'export_date', 'error')
+        self.schema = pa.schema([(column, pa.string() if column in string_columns else pa.float64())
+                                 for column in columns])
+        self.writer = pq.ParquetWriter(out_path, self.schema)
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= PARQUET_ROWS_PER_GROUP:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            table = self.pa.Table.from_pydict({column: [row.get(column) for row in self.rows] for column in self.columns},
+                                              schema=self.schema)
+            self.writer.write_table(table)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def export_studies(studypaths, out_path, workers=None, progress=None):
+    """Analyses every study and writes the rows to out_path (.json for JSON, .parquet for Parquet, otherwise CSV) as
+    they complete.
+    progress, if given, is called as progress(n_done, n_total, row) after each study. Returns the number of studies
+    which failed."""
+    columns = export_columns()
+    extension = os.path.splitext(out_path)[-1].lower()
+    if extension == '.parquet':
+        writer = ParquetRowWriter(out_path, columns)
+    elif extension == '.json':
+        writer = JsonRowWriter(out_path, columns)
+    else:
+        writer = CsvRowWriter(out_path, columns)
+    n_failed = 0
+    try:
+        for i_row, row in enumerate(iter_rows(studypaths, workers=workers)):
+            writer.write(row)
+            if row['error']:
+                n_failed += 1
+            if progress:
+                progress(i_row + 1, len(studypaths), row)
+    finally:
+        writer.close()
+    return n_failed
+
+
+def export_folder(folder, out_path, workers=None, recursive=True, progress=None):
+    return export_studies(find_studies(folder, recursive=recursive), out_path, workers=workers, progress=progress)
+
+
+def expand_paths(patterns, recursive=True):
+    """Studies from a mix of study files, folders and glob patterns (** allowed), without duplicates"""
+    studypaths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        if not matches:
+            print(f"WARNING: Nothing matches {pattern}", file=sys.stderr)
+        for path in matches:
+            if os.path.isdir(path):
+                studypaths.extend(find_studies(path, recursive=recursive))
+            elif os.path.splitext(path)[-1].lower() in analysis.STUDY_EXTENSIONS:
+                studypaths.append(path)
+            elif not glob.has_magic(pattern):
+                print(f"WARNING: Skipping {path} - not a folder or one of {analysis.STUDY_EXTENSIONS}", file=sys.stderr)
+    return list(dict.fromkeys(studypaths))
+
+
+def print_progress(n_done, n_total, row):
+    status = f"FAILED ({row['error']})" if row['error'] else "ok"
+    print(f"[{n_done}/{n_total}] {row['path']}: {status}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Code.Data.batch",
+                                     description="Analyse labelled .txt/.sdy studies and export their metrics, "
+                                                 "one row per study")
+    parser.add_argument('paths', nargs='+', help="Study files, folders of studies, or glob patterns (** allowed)")
+    parser.add_argument('-o', '--output', required=True,
+                        help="Output file - .csv, .json, or .parquet (needs pyarrow)")
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help="Number of worker processes (default: one per CPU; 1 runs in this process)")
+    parser.add_argument('--no-recursive', dest='recursive', action='store_false',
+                        help="Don't look in the subfolders of folders given")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Don't report progress")
+    args = parser.parse_args(argv)
+
+    studypaths = expand_paths(args.paths, recursive=args.recursive)
+    if not studypaths:
+        parser.error("no studies found")
+    if not args.quiet:
+        print(f"Exporting {len(studypaths)} studies to {args.output}", file=sys.stderr)
+    n_failed = export_studies(studypaths, args.output, workers=args.workers,
+                              progress=None if args.quiet else print_progress)
+    print(f"Exported {len(studypaths) - n_failed}/{len(studypaths)} studies to {args.output}"
+          f"{f' ({n_failed} failed)' if n_failed else ''}", file=sys.stderr)
+    return 1 if n_failed else 0
+
+
+if __name__ == "__main__":
+    # Run via the package's module, so process_study pickles as Code.Data.batch.process_study for the workers
+    from Code.Data.batch import main
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""Sidecar cache of parsed studies, so a study only has to be parsed from the raw .txt/.sdy once.
+
+The cache lives next to the study as <study>.cphcache and is laid out as:
+    MAGIC | uint32 header length | JSON header | contiguous arrays (each aligned to ALIGNMENT bytes)
+so every array can be memory-mapped straight back out of the file. The JSON header holds the key the cache was built
+with (source path, mtime, size, parser parameters); if any of it differs the cache is stale and is ignored."""
+
+import os
+import json
+import struct
+import numpy as np
+
+CACHE_EXTENSION = '.cphcache'
+CACHE_VERSION = 2
+MAGIC = b'CPHC'
+ALIGNMENT = 64
+
+
+def cache_path(studypath):
+    return f"{studypath}{CACHE_EXTENSION}"
+
+
+def cache_key(studypath, **params):
+    """Everything the cached arrays depend on - if any of this changes, the cache has to be rebuilt"""
+    stat = os.stat(studypath)
+    key = {'version': CACHE_VERSION,
+           'path': os.path.abspath(studypath),
+           'mtime_ns': stat.st_mtime_ns,
+           'size': stat.st_size,
+           'params': params}
+    return json.loads(json.dumps(key))  # Normalise (e.g. tuples -> lists) so it compares equal to a loaded key
+
+
+def _aligned(n_bytes):
+    return -(-n_bytes // ALIGNMENT) * ALIGNMENT
+
+
+def save_cache(studypath, key, arrays):
+    """Writes the arrays (a dict of name -> np.ndarray) atomically, returning whether it could; failing to write a cache
+    is never fatal"""
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _aligned(offset + array.nbytes)
+    header = json.dumps({'key': key, 'arrays': layout}).encode('utf-8')
+    data_start = _aligned(len(MAGIC) + 4 + len(header))
+
+    path = cache_path(studypath)
+    temp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header)))
+            f.write(header)
+            for name, array in arrays.items():
+                f.seek(data_start + layout[name]['offset'])
+                f.write(array.tobytes())
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Unable to write cache {path}: {e}")
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+
+def load_cache(studypath, key):
+    """Returns a dict of name -> read-only memory-mapped array, or None if there is no valid cache for this key"""
+    path = cache_path(studypath)
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            header_len, = struct.unpack('<I', f.read(4))
+            header = json.loads(f.read(header_len).decode('utf-8'))
+    except (OSError, ValueError, struct.error):
+        return None
+    if header.get('key') != key:
+        return None
+
+    data_start = _aligned(len(MAGIC) + 4 + header_len)
+    file_size = os.path.getsize(path)
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+        n_bytes = int(np.prod(shape)) * dtype.itemsize
+        if data_start + info['offset'] + n_bytes > file_size:  # Truncated
+            return None
+        if n_bytes == 0:  # np.memmap refuses to map an empty region
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=data_start + info['offset'], shape=shape)
+    return arrays
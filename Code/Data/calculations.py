@@ -1,12 +1,14 @@
-import math
+import weakref
 import numpy as np
-import peakutils
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, make_interp_spline
+
+from Code.Data.timeindex import TimeIndex
+
 
 SAMPLE_FREQ = 200
-MIN_RR_S = 0.5
-MIN_RR_SAMPLES = MIN_RR_S * SAMPLE_FREQ
 THRESHOLD = (0.9, 1.1)
+ENSEMBLE_CHANNELS = ('time', 'pa', 'pd', 'flow')  # Order of the channel axis of an ensemble's beats array
+CHANNEL_INDEX = {channel: i_channel for i_channel, channel in enumerate(ENSEMBLE_CHANNELS)}
 
 
 def interpolate_beat(beat, newlen):
@@ -18,30 +20,48 @@ def interpolate_beat(beat, newlen):
     return y_new
 
 
-def average_beats_from_beat_list(beat_list, measure):
-    selected_beats = []
-    for beat in beat_list:
-        selected_beats.append(beat[measure])
-    selected_beats = np.stack(selected_beats)
-    return np.mean(selected_beats, axis=0)
+def resample_beats(waves, starts, ends, newlen):
+    """Resamples every beat (samples starts[i]:ends[i] of each of waves, a (n_channels, n_samples) array) to newlen
+    points with the same cubic spline interpolate_beat() uses. Beats of the same length share their x axis, so each
+    distinct beat length needs just one spline across all of those beats and all channels.
+
+    Returns a (n_beats, n_channels, newlen) array."""
+    starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    resampled = np.empty((len(starts), len(waves), newlen))
+    lengths = ends - starts
+    x_new = np.linspace(0, 1, newlen)
+    for length in np.unique(lengths):
+        i_beats = np.flatnonzero(lengths == length)
+        indices = starts[i_beats, None] + np.arange(length)  # (n_group, length)
+        y = np.moveaxis(waves[:, indices], -1, 0)  # (length, n_channels, n_group)
+        f_interp = make_interp_spline(np.linspace(0, 1, length), y, k=3)
+        resampled[i_beats] = np.transpose(f_interp(x_new), (2, 1, 0))
+    return resampled
+
+
+def average_beats(beats):
+    """Mean beat for every channel at once - (n_channels, n_points)"""
+    return np.mean(beats, axis=0)
 
 
-def ensemble_beats(labelui, rest_or_hyp, max_beats=10):
-    try:
-        if rest_or_hyp == 'rest':
-            time_from, time_to = labelui.slider_group_rest[0].getRegion()  # Can get any slider in the group
-        elif rest_or_hyp == 'hyp':
-            time_from, time_to = labelui.slider_group_hyp[0].getRegion()
-        else:
-            raise ValueError(f"rest_or_hyp must be 'rest' or 'hyp', not {rest_or_hyp}")
-    except (TypeError, IndexError) as e:  # Slider doesn't yet exist
-        return [], 0
+def average_beats_from_beat_list(beats, measure):
+    return np.mean(beats[:, CHANNEL_INDEX[measure]], axis=0)
 
-    pa = np.array(labelui.TxtSdyFile.df['pa'])
-    pd = np.array(labelui.TxtSdyFile.df['pd'])
-    time = np.array(labelui.TxtSdyFile.df['time'])
-    flow = np.array(labelui.TxtSdyFile.df['flow'])
-    i_from, i_to = find_nearest(time, time_from), find_nearest(time, time_to)
+
+def ensemble_beats(study, region, max_beats=10):
+    """Beats of the study (a TxtFile or SDYFile) between the region's (time_from, time_to), resampled to the median
+    beat length. Returns (beats, n_rejected); beats is a (n_beats, n_channels, n_points) array in ENSEMBLE_CHANNELS
+    order."""
+    if region is None:
+        return np.zeros((0, len(ENSEMBLE_CHANNELS), 0)), 0
+    time_from, time_to = region
+
+    pa = study.channel('pa')
+    pd = study.channel('pd')
+    time = study.time
+    flow = study.channel('flow')
+    region_slice = study.time_index.slice(time_from, time_to)
+    i_from, i_to = region_slice.start, region_slice.stop
 
     # Data
     pa = pa[i_from:i_to]
@@ -49,168 +69,162 @@ def ensemble_beats(labelui, rest_or_hyp, max_beats=10):
     time = time[i_from:i_to]
     flow = flow[i_from:i_to]
 
-    # Beats
-    try:
-        peaks = peakutils.indexes(pa, min_dist=int(MIN_RR_SAMPLES))  # Max 180 bpm
-    except ValueError as e:
-        print(f"Problem finding peaks: {e}")
-        return [], 0
-    median_rr = np.median(np.ediff1d(peaks))
-    beats = []
-    n_rejected = 0
-    for i_peak in range(len(peaks) - 1):
-        if len(beats) >= max_beats:
-            print(f"WARNING: Found > {max_beats} beats for {rest_or_hyp} ensemble - skipping remaining beats!")
-            break
-        if THRESHOLD[0] * median_rr < peaks[i_peak + 1] - peaks[i_peak] < THRESHOLD[1] * median_rr:
-            beat_time = time[peaks[i_peak]:peaks[i_peak + 1]] - time[peaks[i_peak]]  # Substract t0
-            beat_pa = pa[peaks[i_peak]:peaks[i_peak + 1]]
-            beat_pd = pd[peaks[i_peak]:peaks[i_peak + 1]]
-            beat_flow = flow[peaks[i_peak]:peaks[i_peak + 1]]
-            beats.append({'time': interpolate_beat(beat_time, median_rr),
-                          'pa': interpolate_beat(beat_pa, median_rr),
-                          'pd': interpolate_beat(beat_pd, median_rr),
-                          'flow': interpolate_beat(beat_flow, median_rr)})
-        else:
-            # print(f"Filtering beat > 10% from median")
-            n_rejected += 1
-    return beats, n_rejected
-
-
-def find_nearest(array, value):
-    idx = np.searchsorted(array, value, side="left")
-    if idx > 0 and (idx == len(array) or math.fabs(value - array[idx - 1]) < math.fabs(value - array[idx])):
-        return idx - 1
+    # Beats - as detect_peaks() would find them in the region's Pa, but from the study's Pa index, so the trace isn't
+    # searched again every time the region moves
+    peaks, rr = study.beat_index('pa').between(i_from, i_to)
+    peaks = peaks - i_from
+    if not len(rr):
+        return np.zeros((0, len(ENSEMBLE_CHANNELS), 0)), 0
+    median_rr = np.median(rr)
+    accepted = (THRESHOLD[0] * median_rr < rr) & (rr < THRESHOLD[1] * median_rr)  # Filter beats > 10% from median
+    i_accepted = np.flatnonzero(accepted)
+    if len(i_accepted) > max_beats:
+        i_accepted = i_accepted[:max_beats]
+    if len(i_accepted) == max_beats and i_accepted[-1] + 1 < len(rr):
+        print(f"WARNING: Found > {max_beats} beats for ensemble {region} - skipping remaining beats!")
+        n_rejected = int(np.sum(~accepted[:i_accepted[-1] + 1]))
     else:
-        return idx
+        n_rejected = int(np.sum(~accepted))
 
-
-def wholecycle_measure(labelui, rest_or_hyp, measure, mean_or_peak):
-    if rest_or_hyp == 'rest':
-        data = labelui.ensemble_data_rest
-    elif rest_or_hyp == 'hyp':
-        data = labelui.ensemble_data_hyp
-    else:
-        raise ValueError(f"Should be rest or hyp, not {rest_or_hyp}")
-    data = average_beats_from_beat_list(data, measure=measure)
-    if mean_or_peak == 'mean':
-        return np.mean(data)
-    elif mean_or_peak == 'peak':
-        return max(data)
-    else:
-        raise ValueError(f"mean_or_peak must be mean or peak, not {mean_or_peak}")
-
-
-def systolic_measure(labelui, rest_or_hyp, measure, mean_or_peak):
-    if rest_or_hyp == 'rest':
-        data = labelui.ensemble_data_rest
-        slider_notch = labelui.slider_notch_rest
-        slider_enddiastole = labelui.slider_enddiastole_rest
-    elif rest_or_hyp == 'hyp':
-        data = labelui.ensemble_data_hyp
-        slider_notch = labelui.slider_notch_hyp
-        slider_enddiastole = labelui.slider_enddiastole_hyp
-    else:
-        raise ValueError(f"Should be rest or hyp, not {rest_or_hyp}")
-    time_notch = slider_notch.value()
-    time_enddiastole = slider_enddiastole.value()
-    time = data[0]['time']
-    i_notch = find_nearest(time, time_notch)
-    i_enddiastole = find_nearest(time, time_enddiastole)
-    sys_measure = np.concatenate((average_beats_from_beat_list(data, measure=measure)[:i_notch],
-                                  average_beats_from_beat_list(data, measure=measure)[i_enddiastole:]))
-    if mean_or_peak == 'mean':
-        return np.mean(sys_measure)
-    elif mean_or_peak == 'peak':
-        return max(sys_measure)
-    else:
-        raise ValueError(f"mean_or_peak must be mean or peak, not {mean_or_peak}")
-
-
-def wavefree_measure(labelui, rest_or_hyp, measure, mean_or_peak):
-    if rest_or_hyp == 'rest':
-        data = labelui.ensemble_data_rest
-        slider_notch = labelui.slider_notch_rest
-        slider_enddiastole = labelui.slider_enddiastole_rest
-    elif rest_or_hyp == 'hyp':
-        data = labelui.ensemble_data_hyp
-        slider_notch = labelui.slider_notch_hyp
-        slider_enddiastole = labelui.slider_enddiastole_hyp
-    else:
-        raise ValueError(f"Should be rest or hyp, not {rest_or_hyp}")
-    time_notch = slider_notch.value()
-    time_enddiastole = slider_enddiastole.value()
-    time_wavefree_start = time_notch + ((time_enddiastole - time_notch) * 0.25)
-    time_wavefree_end = time_enddiastole - 0.005
-    time = data[0]['time']
-    i_wavefree_start = find_nearest(time, time_wavefree_start)
-    i_wavefree_end = find_nearest(time, time_wavefree_end)
-
-    wavefree_measure = average_beats_from_beat_list(data, measure=measure)[i_wavefree_start: i_wavefree_end]
-    try:
-        if mean_or_peak == 'mean':
-            return np.mean(wavefree_measure)
-        elif mean_or_peak == 'peak':
-            return max(wavefree_measure)
-        else:
-            raise ValueError(f"mean_or_peak must be mean or peak, not {mean_or_peak}")
-    except ValueError as e:
-        print(f"Error - did you put the sliders the wrong way around? ({e})")
-        return 0
-
-
-def diastolic_measure(labelui, rest_or_hyp, measure, mean_or_peak):
-    if rest_or_hyp == 'rest':
-        data = labelui.ensemble_data_rest
-        slider_notch = labelui.slider_notch_rest
-        slider_enddiastole = labelui.slider_enddiastole_rest
-    elif rest_or_hyp == 'hyp':
-        data = labelui.ensemble_data_hyp
-        slider_notch = labelui.slider_notch_hyp
-        slider_enddiastole = labelui.slider_enddiastole_hyp
-    else:
-        raise ValueError(f"Should be rest or hyp, not {rest_or_hyp}")
-    time_notch = slider_notch.value()
-    time_enddiastole = slider_enddiastole.value()
-    time = data[0]['time']
-    i_notch = find_nearest(time, time_notch)
-    i_enddiastole = find_nearest(time, time_enddiastole)
-    dias_measure = average_beats_from_beat_list(data, measure=measure)[i_notch:i_enddiastole]
-    if mean_or_peak == 'mean':
-        return np.mean(dias_measure)
-    elif mean_or_peak == 'peak':
-        return max(dias_measure)
-    else:
-        raise ValueError(f"mean_or_peak must be mean or peak, not {mean_or_peak}")
+    waves = np.stack((time, pa, pd, flow))  # In ENSEMBLE_CHANNELS order
+    beats = resample_beats(waves, peaks[i_accepted], peaks[i_accepted + 1], int(median_rr))
+    beats[:, CHANNEL_INDEX['time']] -= waves[CHANNEL_INDEX['time'], peaks[i_accepted], None]  # Substract t0
+    return beats, n_rejected
 
 
-def dpr_measure(labelui, rest_or_hyp, measure, mean_or_peak):
-    if rest_or_hyp == 'rest':
-        data = labelui.ensemble_data_rest
-    elif rest_or_hyp == 'hyp':
-        data = labelui.ensemble_data_hyp
-    else:
-        raise ValueError(f"Should be rest or hyp, not {rest_or_hyp}")
-    pa = average_beats_from_beat_list(data, measure='pa')
-    mean_pa = np.mean(pa)
-    data = average_beats_from_beat_list(data, measure=measure)
-    # print(f"Pre filtering: {data.shape}")
-    diastolic_data = data[pa < mean_pa]
-    # print(f"Filtered to {diastolic_data.shape} - {np.sum(pa < mean_pa)}")
-    if mean_or_peak == 'mean':
-        return np.mean(diastolic_data)
-    elif mean_or_peak == 'peak':
-        return max(diastolic_data)
-    else:
-        raise ValueError(f"mean_or_peak must be mean or peak, not {mean_or_peak}")
-
-
-def rfr(labelui):
-    data = labelui.ensemble_data_rest
-    pa = average_beats_from_beat_list(data, measure='pa')
-    pd = average_beats_from_beat_list(data, measure='pd')
-    rfr_cycle = pd/pa
-    # import matplotlib.pyplot as plt
-    # plt.plot(rfr_cycle)
-    # plt.show()
-    return min(rfr_cycle)
\ No newline at end of file
+class Ensemble:
+    """The accepted beats for one state (rest or hyperaemia) of a study. The mean beat of every channel is computed once,
+    and the phase windows (which depend on the notch & end-diastole markers) and every measure taken from them are
+    cached until the markers move. A new Ensemble is only built when the region (or the study) changes."""
+
+    PHASES = ('wholecycle', 'systolic', 'diastolic', 'wavefree', 'dpr')
+    MARKER_PHASES = ('systolic', 'diastolic', 'wavefree')  # Phases which need the notch & end-diastole markers
+
+    def __init__(self, beats, n_rejected=0, key=None):
+        self.beats = beats
+        self.n_rejected = n_rejected
+        self.key = key  # What the beats were built from - see build_ensemble()
+        self.notch, self.enddiastole = None, None
+        self._mean_beats = None
+        self._time_index = None
+        self._windows = {}
+        self._measures = {}
+
+    def __len__(self):
+        return len(self.beats)
+
+    @property
+    def time(self):
+        return self.beats[0, CHANNEL_INDEX['time']]
+
+    @property
+    def time_index(self):
+        if self._time_index is None:
+            self._time_index = TimeIndex(self.time)
+        return self._time_index
+
+    @property
+    def has_markers(self):
+        return self.notch is not None and self.enddiastole is not None
+
+    def mean_beat(self, measure):
+        """measure can be any of ENSEMBLE_CHANNELS, or 'pdpa' for the ratio of the mean Pd & Pa beats"""
+        if self._mean_beats is None:
+            self._mean_beats = average_beats(self.beats)
+        if measure == 'pdpa':
+            return self.mean_beat('pd') / self.mean_beat('pa')
+        return self._mean_beats[CHANNEL_INDEX[measure]]
+
+    def set_markers(self, time_notch, time_enddiastole):
+        """Either can be None if that marker hasn't been placed, in which case the marker phases are unavailable"""
+        if (time_notch, time_enddiastole) != (self.notch, self.enddiastole):
+            self.notch, self.enddiastole = time_notch, time_enddiastole
+            for phase in self.MARKER_PHASES:
+                self._windows.pop(phase, None)
+            self._measures = {key: value for key, value in self._measures.items() if key[0] not in self.MARKER_PHASES}
+
+    def window(self, phase):
+        """Something to index a mean beat with, to get just the given phase of the cardiac cycle"""
+        if phase not in self._windows:
+            if phase in self.MARKER_PHASES and not self.has_markers:
+                raise ValueError(f"The notch and end-diastole markers are needed for the {phase} phase")
+            if phase == 'wholecycle':
+                window = slice(None)
+            elif phase == 'systolic':
+                i_notch = self.time_index.index(self.notch)
+                i_enddiastole = self.time_index.index(self.enddiastole)
+                window = np.r_[0:i_notch, i_enddiastole:len(self.time)]
+            elif phase == 'diastolic':
+                window = self.time_index.slice(self.notch, self.enddiastole)
+            elif phase == 'wavefree':
+                time_wavefree_start = self.notch + ((self.enddiastole - self.notch) * 0.25)
+                time_wavefree_end = self.enddiastole - 0.005
+                window = self.time_index.slice(time_wavefree_start, time_wavefree_end)
+            elif phase == 'dpr':
+                # Not 'true' diastole, just the period below mean Pa
+                pa = self.mean_beat('pa')
+                window = pa < np.mean(pa)
+            else:
+                raise ValueError(f"phase must be one of {self.PHASES}, not {phase}")
+            self._windows[phase] = window
+        return self._windows[phase]
+
+    def measure(self, phase, measure, mean_or_peak):
+        key = (phase, measure, mean_or_peak)
+        if key not in self._measures:
+            values = self.mean_beat(measure)[self.window(phase)]
+            try:
+                if mean_or_peak == 'mean':
+                    value = np.mean(values)
+                elif mean_or_peak == 'peak':
+                    value = max(values)
+                elif mean_or_peak == 'min':
+                    value = min(values)
+                else:
+                    raise ValueError(f"mean_or_peak must be mean, peak or min, not {mean_or_peak}")
+            except ValueError as e:
+                if phase != 'wavefree':
+                    raise
+                print(f"Error - did you put the sliders the wrong way around? ({e})")
+                value = 0
+            self._measures[key] = value
+        return self._measures[key]
+
+    def rfr(self):
+        return self.measure('wholecycle', 'pdpa', 'min')
+
+
+def build_ensemble(study, region, previous=None, max_beats=10):
+    """Returns previous unchanged if it was built from the same study and region, otherwise a new Ensemble"""
+    region = tuple(region) if region is not None else None
+    # A weak reference, not id(study) - once a study has been freed its id can be reused by another, but a dead reference
+    # never compares equal to a new one
+    key = (weakref.ref(study), getattr(study, 'pa_channel', None), region)
+    if previous is not None and previous.key == key:
+        return previous
+    beats, n_rejected = ensemble_beats(study, region, max_beats=max_beats)
+    return Ensemble(beats, n_rejected, key=key)
+
+
+def wholecycle_measure(ensemble, measure, mean_or_peak):
+    return ensemble.measure('wholecycle', measure, mean_or_peak)
+
+
+def systolic_measure(ensemble, measure, mean_or_peak):
+    return ensemble.measure('systolic', measure, mean_or_peak)
+
+
+def wavefree_measure(ensemble, measure, mean_or_peak):
+    return ensemble.measure('wavefree', measure, mean_or_peak)
+
+
+def diastolic_measure(ensemble, measure, mean_or_peak):
+    return ensemble.measure('diastolic', measure, mean_or_peak)
+
+
+def dpr_measure(ensemble, measure, mean_or_peak):
+    return ensemble.measure('dpr', measure, mean_or_peak)
+
+
+def rfr(ensemble):
+    return ensemble.rfr()
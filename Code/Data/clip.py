@@ -0,0 +1,61 @@
+"""Clipping & forward-filling of pressure traces, in place.
+
+Values above a threshold (median + n_quantiles * quantile of a reference trace - e.g. flush & zeroing artefacts) are
+replaced by the last good value before them. Finding the threshold partitions one copy of the reference trace; the fill
+itself needs just one full-length boolean mask, plus indices of the clipped samples - which are few, and come in short
+runs, so the fill works run by run."""
+
+import numpy as np
+
+SIGNAL_DTYPE = np.float32  # As TxtFile - plenty for mmHg & cm/s, and half the memory of float64
+
+
+def quantiles(wave, qs):
+    """The qs quantiles of wave, ignoring NaNs - the same values as np.nanquantile's default (linear) method, but
+    all from a single np.partition of one copy of wave (without its NaNs)"""
+    wave = np.asarray(wave)
+    values = None
+    if np.issubdtype(wave.dtype, np.floating):
+        valid = np.isnan(wave)
+        if valid.any():
+            values = wave[np.logical_not(valid, out=valid)]
+    if values is None:
+        values = wave.copy()
+    if not len(values):
+        return np.full(len(qs), np.nan)
+    positions = np.asarray(qs, dtype=np.float64) * (len(values) - 1)
+    i_below = np.floor(positions).astype(np.int64)
+    i_above = np.ceil(positions).astype(np.int64)
+    values.partition(np.unique(np.concatenate((i_below, i_above))))
+    below, above = values[i_below].astype(np.float64), values[i_above].astype(np.float64)
+    return below + (above - below) * (positions - i_below)
+
+
+def clip_threshold(ref_wave, quantile, n_quantiles):
+    """The threshold SDYFile has always clipped at - median + n_quantiles * quantile of ref_wave"""
+    median, quantile_value = quantiles(ref_wave, (0.5, quantile))
+    return median + n_quantiles * quantile_value
+
+
+def clip_fill(wave, threshold, carry=np.nan):
+    """Replaces, in place, every value of wave above threshold (or NaN) with the last value before it that wasn't.
+    Leading values are replaced with carry (e.g. the last value of the previous block, if streaming). Returns wave."""
+    bad = np.less_equal(wave, threshold)
+    np.logical_not(bad, out=bad)  # Also catches NaNs
+    if not bad.any():
+        return wave
+    i_bad = np.flatnonzero(bad)
+    del bad
+    i_breaks = np.flatnonzero(np.diff(i_bad) != 1)  # Between runs
+    run_starts = i_bad[np.concatenate(([0], i_breaks + 1))]
+    run_ends = i_bad[np.concatenate((i_breaks, [len(i_bad) - 1]))] + 1
+    fills = wave[np.maximum(run_starts - 1, 0)]
+    if run_starts[0] == 0:
+        fills[0] = carry
+    wave[i_bad] = np.repeat(fills, run_ends - run_starts)
+    return wave
+
+
+def forward_fill(wave, carry=np.nan):
+    """Replaces, in place, every NaN in wave with the last value before it that wasn't NaN"""
+    return clip_fill(wave, np.inf, carry=carry)
@@ -0,0 +1,105 @@
+"""A persistent index of the studies in a folder, so browsing a folder doesn't mean opening every study in it.
+
+Each study's size & modification time is kept in studies.cphindex in the folder, so a scan just lists the folder - it
+doesn't open any of the studies. Header metadata (patient, dates) is only read when it's asked for, and is then kept in
+the index until the study changes. Label counts come from the folder's label store (see labelstore.py), which is one
+read."""
+
+import os
+import json
+
+from Code.Data.analysis import STUDY_EXTENSIONS
+from Code.Data.TxtFile import TxtFile
+from Code.Data.SDYFile import SDYFile
+
+INDEX_FILENAME = 'studies.cphindex'
+SCHEMA_VERSION = 1
+
+
+def read_study_header(studypath):
+    """{'patient_id', 'study_date', 'export_date'}, as strings, without reading any of the data"""
+    extension = os.path.splitext(studypath)[-1].lower()
+    if extension == '.txt':
+        header = TxtFile.read_header(studypath)
+    elif extension == '.sdy':
+        header = SDYFile.read_header(studypath)
+    else:
+        raise ValueError(f"Unknown study type {extension} for {studypath}, expected one of {STUDY_EXTENSIONS}")
+    return {key: str(header[key]) for key in ('patient_id', 'study_date', 'export_date')}
+
+
+class FolderIndex:
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, INDEX_FILENAME)
+        self.studies = {}  # Study file name -> {'mtime_ns', 'size'}, + 'patient_id', 'study_date', 'export_date' (or
+        # 'error') once header() has read them
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            print(f"WARNING: {self.path} is unreadable - rescanning the whole folder")
+            return
+        if index.get('schema') != SCHEMA_VERSION:
+            print(f"WARNING: {self.path} is schema version {index.get('schema')}, not {SCHEMA_VERSION} - rescanning")
+            return
+        self.studies = index['studies']
+
+    def save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'schema': SCHEMA_VERSION, 'studies': self.studies}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:  # e.g. a read-only share - the index still works, it just won't persist
+            print(f"WARNING: Unable to write {self.path}: {e}")
+
+    def scan(self):
+        """Brings the index up to date with the folder, without opening any studies - those added or changed since the
+        last scan just lose any header read before. Returns the file names (added, changed, removed)."""
+        found = {}
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file() and os.path.splitext(entry.name)[-1].lower() in STUDY_EXTENSIONS:
+                    stat = entry.stat()
+                    found[entry.name] = (stat.st_mtime_ns, stat.st_size)
+
+        added, changed = [], []
+        removed = [name for name in self.studies if name not in found]
+        for name in removed:
+            del self.studies[name]
+        for name, (mtime_ns, size) in sorted(found.items()):
+            study = self.studies.get(name)
+            if study and (study['mtime_ns'], study['size']) == (mtime_ns, size):
+                continue
+            (changed if study else added).append(name)
+            self.studies[name] = {'mtime_ns': mtime_ns, 'size': size}
+
+        if added or changed or removed:
+            self.save()
+        return added, changed, removed
+
+    def header(self, name):
+        """The header metadata of study file name (see read_study_header()), reading it if it isn't indexed yet - or
+        {'error'} if it can't be read"""
+        study = self.studies[name]
+        if 'patient_id' not in study and 'error' not in study:
+            try:
+                study.update(read_study_header(os.path.join(self.folder, name)))
+            except Exception as e:  # Still listed; it'll fail properly if opened
+                study['error'] = f"{type(e).__name__}: {e}"
+            self.save()
+        keys = ('error',) if 'error' in study else ('patient_id', 'study_date', 'export_date')
+        return {key: study[key] for key in keys}
+
+    def study_paths(self):
+        """Paths of the studies, .txt files first (as LabelUI has always listed them)"""
+        def order(name):
+            return STUDY_EXTENSIONS.index(os.path.splitext(name)[-1].lower()), name
+        names = sorted(self.studies, key=order)
+        return [os.path.join(self.folder, name) for name in names]
@@ -0,0 +1,221 @@
+"""Reading & writing the labels placed in LabelUI, without needing the GUI. See analysis.py for the label record format.
+
+The labels of every study in a folder are kept in one file in that folder, labels.cphstore - JSON lines, the first a
+header with the schema version, then one {"study": <file name>, "labels": {...}} line per save. Saving appends a line
+(the last line for a study wins), and once most lines are out of date the file is rewritten with just the latest, to a
+temporary file which then replaces it, so it is never left half-written. Listing a folder is therefore one read,
+however many studies it has.
+
+Labels used to be saved next to each study as <study>.cph (a pickled label record). Opening a folder's store imports any
+.cph files for studies it doesn't have yet; the .cph files are left where they are, but aren't read again.
+
+A store opened read_only (e.g. in the worker processes of a batch export, many of which may open the same store at once)
+never writes the file - .cph labels are only imported in memory (once - they're kept across re-reads of the store), and
+put() isn't allowed."""
+
+import os
+import json
+import glob
+import time
+import pickle
+import threading
+
+STORE_FILENAME = 'labels.cphstore'
+SCHEMA_VERSION = 1
+CPH_EXTENSION = '.cph'
+COMPACT_MIN_LINES = 64  # Rewrite the store once it has at least this many lines, and over twice as many as studies
+TUPLE_KEYS = ('range_rest', 'range_hyp')  # Saved as JSON lists; returned as tuples, as LabelUI saves them
+
+
+def cph_path(studypath):
+    return f"{studypath}{CPH_EXTENSION}"
+
+
+def load_cph(filename):
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    else:
+        # Save file not found
+        return {}
+
+
+def to_json(labels):
+    """Label records from the UI may hold numpy floats, which json can't write"""
+    return {key: [float(v) for v in value] if key in TUPLE_KEYS else
+                 (value if isinstance(value, bool) else float(value))
+            for key, value in labels.items() if value is not None}
+
+
+def from_json(labels):
+    return {key: tuple(value) if key in TUPLE_KEYS else value for key, value in labels.items()}
+
+
+class LabelStore:
+    """The labels of every study in one folder. Safe to share between threads; re-reads the file if another process has
+    written to it since."""
+
+    def __init__(self, folder, read_only=False):
+        self.folder = folder
+        self.read_only = read_only
+        self.path = os.path.join(folder, STORE_FILENAME)
+        self.index = {}  # Study file name -> labels
+        self.imported = {}  # Study file name -> labels imported from its .cph file
+        self.n_lines = 0
+        self.stat = None
+        self.lock = threading.Lock()
+        with self.lock:
+            self.read()
+            self.migrate_cph()
+
+    def file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def read(self):
+        """Loads the store. One whose header can't be read (or is from a newer Cophy) is moved aside, with a warning,
+        and the store treated as empty - listing a folder mustn't fail because of it"""
+        self.index, self.n_lines = {}, 0
+        self.stat = self.file_stat()
+        if self.stat is None:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8', errors='replace') as f:
+                header = f.readline()
+                try:
+                    schema = json.loads(header)['schema']
+                except (ValueError, KeyError, TypeError):
+                    self.set_aside(f"{self.path} isn't a label store")
+                    return
+                if not isinstance(schema, int) or schema > SCHEMA_VERSION:
+                    self.set_aside(f"{self.path} is schema version {schema}, but this version of Cophy only reads "
+                                   f"up to {SCHEMA_VERSION} - please update")
+                    return
+                for i_line, line in enumerate(f, start=2):
+                    try:
+                        entry = json.loads(line)
+                        self.index[entry['study']] = from_json(entry['labels'])
+                        self.n_lines += 1
+                    except (ValueError, KeyError, TypeError):
+                        # e.g. the last line if a save was interrupted - the labels before are still good
+                        print(f"WARNING: Skipping unreadable line {i_line} of {self.path}")
+        except OSError as e:
+            print(f"WARNING: Unable to read {self.path}: {e}")
+            self.index, self.n_lines = {}, 0
+
+    def set_aside(self, reason):
+        """Moves an unreadable store out of the way (unless read-only), so saving starts a new one"""
+        self.index, self.n_lines = {}, 0
+        if self.read_only:
+            print(f"WARNING: {reason} - ignoring it")
+            return
+        aside_path = f"{self.path}.unreadable-{time.strftime('%Y%m%d-%H%M%S')}"
+        n_aside = 1
+        while os.path.exists(aside_path):  # Never replace one set aside before
+            n_aside += 1
+            aside_path = f"{self.path}.unreadable-{time.strftime('%Y%m%d-%H%M%S')}-{n_aside}"
+        try:
+            os.replace(self.path, aside_path)
+            print(f"WARNING: {reason} - moved it to {aside_path}")
+        except OSError as e:
+            print(f"WARNING: {reason}, and it couldn't be moved aside ({e}) - ignoring it")
+        self.stat = self.file_stat()
+
+    def refresh(self):
+        if self.file_stat() != self.stat:
+            self.read()
+            if self.read_only:  # The .cph labels were only ever imported in memory - put them back, without reloading
+                for study, labels in self.imported.items():
+                    self.index.setdefault(study, labels)
+
+    def migrate_cph(self):
+        n_imported = 0
+        for cph_filename in sorted(glob.glob(os.path.join(glob.escape(self.folder), f"*{CPH_EXTENSION}"))):
+            study = os.path.basename(cph_filename)[:-len(CPH_EXTENSION)]
+            if study in self.index:
+                continue
+            try:
+                labels = load_cph(cph_filename)
+            except Exception as e:
+                print(f"WARNING: Unable to import {cph_filename}: {e}")
+                continue
+            self.index[study] = self.imported[study] = from_json(to_json(labels))
+            n_imported += 1
+        if n_imported and not self.read_only:
+            try:
+                self.rewrite()
+                print(f"Imported the labels of {n_imported} studies from .cph files into {self.path}")
+            except OSError as e:  # e.g. a read-only share - the imported labels can still be read
+                print(f"WARNING: Unable to write {self.path}: {e}")
+
+    def get(self, studypath):
+        """The study's labels (empty if it has none)"""
+        with self.lock:
+            self.refresh()
+            return dict(self.index.get(os.path.basename(studypath), {}))
+
+    def counts(self):
+        """{study file name: number of labels}"""
+        with self.lock:
+            self.refresh()
+            return {study: len([key for key in labels if key != 'pa']) for study, labels in self.index.items()}
+
+    def put(self, studypath, labels):
+        if self.read_only:
+            raise PermissionError(f"{self.path} was opened read-only")
+        study = os.path.basename(studypath)
+        with self.lock:
+            self.refresh()
+            self.index[study] = from_json(to_json(labels))
+            if self.stat is None:
+                self.rewrite()
+                return
+            line = json.dumps({'study': study, 'labels': to_json(labels)}) + "\n"
+            with open(self.path, 'a+b') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":  # An interrupted save left half a line - don't append to it
+                    line = "\n" + line
+                f.write(line.encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+            self.n_lines += 1
+            self.stat = self.file_stat()
+            if self.n_lines >= COMPACT_MIN_LINES and self.n_lines > 2 * len(self.index):
+                self.rewrite()
+
+    def rewrite(self):
+        """Writes just the latest labels of each study, atomically replacing the store"""
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'schema': SCHEMA_VERSION}) + "\n")
+            for study in sorted(self.index):
+                f.write(json.dumps({'study': study, 'labels': to_json(self.index[study])}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.n_lines = len(self.index)
+        self.stat = self.file_stat()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(folder, read_only=False):
+    """The LabelStore of a folder, shared by everything in this process"""
+    folder = os.path.abspath(folder)
+    with _stores_lock:
+        if (folder, read_only) not in _stores:
+            _stores[folder, read_only] = LabelStore(folder, read_only=read_only)
+        return _stores[folder, read_only]
+
+
+def load_labels(studypath, read_only=False):
+    return open_store(os.path.dirname(os.path.abspath(studypath)), read_only=read_only).get(studypath)
+
+
+def save_labels(studypath, labels):
+    open_store(os.path.dirname(os.path.abspath(studypath))).put(studypath, labels)
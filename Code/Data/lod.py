@@ -0,0 +1,59 @@
+"""Level-of-detail for long traces - a min/max envelope pyramid, built once per trace, from which a decimated copy sized
+to the visible x range and the plot's pixel width can be cut in O(pixels), whatever the length of the recording.
+
+Each level halves the one below it, keeping the min & max of each bucket, so drawing the envelope (min then max of each
+bucket) looks the same as drawing every sample - no peaks are lost - but needs only ~2 vertices per pixel."""
+
+import numpy as np
+
+from Code.Data.timeindex import SampleClock
+
+MIN_BUCKETS = 256  # Don't build levels coarser than this; a whole trace never needs fewer buckets than a plot has pixels
+
+
+class EnvelopePyramid:
+    def __init__(self, x, y):
+        """x must be ascending (a time axis, or a SampleClock); NaNs in y are ignored unless a whole bucket is NaN"""
+        self.x = x if isinstance(x, SampleClock) else np.asarray(x)
+        self.y = np.asarray(y)
+        self.levels = []  # levels[k] is (mins, maxs) for buckets of 2 ** (k + 1) samples
+        mins, maxs = self.y, self.y
+        while len(mins) > MIN_BUCKETS * 2:
+            mins, maxs = self.halve(mins, np.fmin), self.halve(maxs, np.fmax)
+            self.levels.append((mins, maxs))
+
+    @staticmethod
+    def halve(values, function):
+        if len(values) % 2:
+            values = np.append(values, values[-1])
+        return function(values[0::2], values[1::2])
+
+    def __len__(self):
+        return len(self.y)
+
+    def view(self, x_from, x_to, n_pixels):
+        """(x, y) to plot between x_from and x_to on a plot n_pixels wide - every sample if there are no more than ~2 per
+        pixel, otherwise the min & max of each bucket (one bucket per pixel or less), in order"""
+        n_pixels = max(int(n_pixels), 1)
+        i_from = max(self.x.searchsorted(x_from, side='right') - 1, 0)  # Include a sample either side of the view
+        i_to = min(self.x.searchsorted(x_to, side='left') + 1, len(self.x))
+        n_samples = i_to - i_from
+        if n_samples <= 2 * n_pixels or not self.levels:
+            return self.x[i_from:i_to], self.y[i_from:i_to]
+
+        i_level = min(int(np.ceil(np.log2(n_samples / n_pixels))), len(self.levels)) - 1
+        bucket = 2 ** (i_level + 1)
+        mins, maxs = self.levels[i_level]
+        i_bucket_from, i_bucket_to = i_from // bucket, -(-i_to // bucket)
+        if 2 * (i_bucket_to - i_bucket_from) >= n_samples:  # The envelope wouldn't be any smaller than the samples
+            return self.x[i_from:i_to], self.y[i_from:i_to]
+        x = np.repeat(self.x[i_bucket_from * bucket:i_bucket_to * bucket:bucket], 2)
+        y = np.empty(len(x), dtype=mins.dtype)
+        y[0::2] = mins[i_bucket_from:i_bucket_to]
+        y[1::2] = maxs[i_bucket_from:i_bucket_to]
+        return x, y
+
+
+def study_pyramids(study, channels=('pa', 'pd', 'flow')):
+    """{channel: EnvelopePyramid} against the study's time axis"""
+    return {channel: EnvelopePyramid(study.time, study.channel(channel)) for channel in channels}
@@ -0,0 +1,167 @@
+"""Registry of every physiology index, each declared in terms of what it needs rather than how to get it.
+
+The leaves are Quantities - a mean/peak of one channel of an ensemble's mean beat over one phase of the cycle, at rest
+or hyperaemia. Intermediates (e.g. the rest trans-stenotic gradient) and metrics are nodes computed from Quantities and
+other nodes, so together they form a DAG. evaluate() computes every node at most once, and only evaluates the metrics
+whose inputs are available (e.g. no hyperaemic metrics until there is a hyperaemic ensemble, and no wave-free metrics
+until the markers are placed). Nothing here needs the GUI.
+
+To add a metric, add a metric(...) line below; existing metrics are unaffected, and any intermediate it shares with them
+is still only computed once."""
+
+from collections import namedtuple
+
+from Code.Data.calculations import Ensemble
+
+GROUPS = ('pressures', 'pressure_ratios', 'flows', 'flow_ratios', 'resistances')
+STATES = ('rest', 'hyp')
+
+
+class Quantity(namedtuple('Quantity', ('state', 'phase', 'channel', 'reduction'))):
+    """e.g. Quantity('hyp', 'wholecycle', 'pd', 'mean') is mean hyperaemic Pd over the whole cycle"""
+
+    def available(self, ensembles):
+        ensemble = ensembles.get(self.state)
+        if not ensemble:
+            return False
+        return self.phase not in Ensemble.MARKER_PHASES or ensemble.has_markers
+
+    def compute(self, ensembles):
+        return ensembles[self.state].measure(self.phase, self.channel, self.reduction)
+
+
+Node = namedtuple('Node', ('key', 'inputs', 'function'))
+Metric = namedtuple('Metric', ('group', 'name', 'state', 'phase', 'key'))
+
+NODES = {}
+METRICS = []
+
+
+def node(key, inputs, function):
+    """Registers an intermediate; inputs are Quantities or keys of nodes already registered, so there can't be cycles"""
+    for input_key in inputs:
+        if not isinstance(input_key, Quantity) and input_key not in NODES:
+            raise KeyError(f"Node {key} depends on {input_key}, which hasn't been registered")
+    NODES[key] = Node(key, tuple(inputs), function)
+    return key
+
+
+def metric(group, name, inputs, function=None, state=None, phase=None):
+    """Registers a metric for display/export. With no function, the metric is just the value of its single input"""
+    if group not in GROUPS:
+        raise ValueError(f"group must be one of {GROUPS}, not {group}")
+    key = node((group, name, state, phase), inputs, function or identity)
+    METRICS.append(Metric(group, name, state, phase, key))
+    return key
+
+
+def identity(value):
+    return value
+
+
+def ratio(numerator, denominator):
+    return numerator / denominator
+
+
+def difference(a, b):
+    return a - b
+
+
+def wc(state, channel, reduction):
+    return Quantity(state, 'wholecycle', channel, reduction)
+
+
+class Evaluator:
+    """Evaluates nodes against a set of ensembles ({'rest': Ensemble, 'hyp': Ensemble}, either may be None),
+    remembering every value so shared inputs are only ever computed once"""
+
+    def __init__(self, ensembles):
+        self.ensembles = ensembles
+        self.values = {}
+        self._available = {}
+
+    def available(self, key):
+        if key not in self._available:
+            if isinstance(key, Quantity):
+                self._available[key] = key.available(self.ensembles)
+            else:
+                self._available[key] = all(self.available(input_key) for input_key in NODES[key].inputs)
+        return self._available[key]
+
+    def value(self, key):
+        if key not in self.values:
+            if isinstance(key, Quantity):
+                self.values[key] = key.compute(self.ensembles)
+            else:
+                inputs = NODES[key]
+                try:
+                    self.values[key] = inputs.function(*(self.value(input_key) for input_key in inputs.inputs))
+                except ZeroDivisionError:
+                    self.values[key] = 0
+        return self.values[key]
+
+
+def evaluate(ensembles, metrics=None):
+    """Returns {group: [{'name', ('state'), ('phase'), 'value'}, ...]} for every available metric, in registry order"""
+    evaluator = Evaluator(ensembles)
+    calculations = {group: [] for group in GROUPS}
+    for m in (METRICS if metrics is None else metrics):
+        if not evaluator.available(m.key):
+            continue
+        row = {'name': m.name}
+        if m.state is not None:
+            row['state'] = m.state
+        if m.phase is not None:
+            row['phase'] = m.phase
+        row['value'] = evaluator.value(m.key)
+        calculations[m.group].append(row)
+    return calculations
+
+
+# Whole cycle, needing just an ensemble
+for _state in STATES:
+    for _reduction in ('mean', 'peak'):
+        metric('pressures', 'WC Pa', [wc(_state, 'pa', _reduction)], state=_state, phase=_reduction)
+        metric('pressures', 'WC Pd', [wc(_state, 'pd', _reduction)], state=_state, phase=_reduction)
+    if _state == 'rest':
+        metric('pressure_ratios', 'WC PdPa', [wc('rest', 'pd', 'mean'), wc('rest', 'pa', 'mean')], ratio)
+        metric('pressure_ratios', 'dPR', [Quantity('rest', 'dpr', 'pd', 'mean'), Quantity('rest', 'dpr', 'pa', 'mean')],
+               ratio)
+        metric('pressure_ratios', 'RFR', [wc('rest', 'pdpa', 'min')])
+    else:
+        metric('pressure_ratios', 'FFR', [wc('hyp', 'pd', 'mean'), wc('hyp', 'pa', 'mean')], ratio)
+    for _reduction in ('mean', 'peak'):
+        metric('flows', 'WC Flow', [wc(_state, 'flow', _reduction)], state=_state, phase=_reduction)
+
+    _p_delta = node(('p_delta', _state), [wc(_state, 'pa', 'mean'), wc(_state, 'pd', 'mean')], difference)
+    _stenosis, _microvascular = ('BSR', 'BMR') if _state == 'rest' else ('HSR', 'HMR')
+    for _reduction in ('mean', 'peak'):
+        metric('resistances', _stenosis, [_p_delta, wc(_state, 'flow', _reduction)], ratio, phase=_reduction)
+    for _reduction in ('mean', 'peak'):
+        metric('resistances', _microvascular, [wc(_state, 'pd', 'mean'), wc(_state, 'flow', _reduction)], ratio,
+               phase=_reduction)
+
+for _reduction in ('mean', 'peak'):
+    metric('flow_ratios', 'CFR', [wc('hyp', 'flow', _reduction), wc('rest', 'flow', _reduction)], ratio,
+           phase=_reduction)
+
+# Systolic & wave-free, also needing the notch & end-diastole markers
+for _state in STATES:
+    metric('pressures', 'Sysolic Pa', [Quantity(_state, 'systolic', 'pa', 'mean')], state=_state, phase='mean')
+    metric('pressures', 'Sysolic Pd', [Quantity(_state, 'systolic', 'pd', 'mean')], state=_state, phase='mean')
+    for _reduction in ('mean', 'peak'):
+        metric('pressures', 'Wavefree Pa', [Quantity(_state, 'wavefree', 'pa', _reduction)], state=_state,
+               phase=_reduction)
+        metric('pressures', 'Wavefree Pd', [Quantity(_state, 'wavefree', 'pd', _reduction)], state=_state,
+               phase=_reduction)
+    metric('pressure_ratios', 'iFR' if _state == 'rest' else 'iFRa',
+           [Quantity(_state, 'wavefree', 'pd', 'mean'), Quantity(_state, 'wavefree', 'pa', 'mean')], ratio)
+    for _reduction in ('mean', 'peak'):
+        metric('flows', 'Wavefree flow', [Quantity(_state, 'wavefree', 'flow', _reduction)], state=_state,
+               phase=_reduction)
+
+for _phase, _name in (('systolic', 'Systolic CFR'), ('wavefree', 'Wavefree CFR')):
+    for _reduction in ('mean', 'peak'):
+        metric('flow_ratios', _name,
+               [Quantity('hyp', _phase, 'flow', _reduction), Quantity('rest', _phase, 'flow', _reduction)], ratio,
+               phase=_reduction)
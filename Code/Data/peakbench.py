@@ -0,0 +1,105 @@
+"""Benchmarks the peak detection methods in peaks.py - throughput, and agreement with the detector Cophy has always used
+(peakutils) - on synthetic pressure traces and on the Pa/Pd of any studies given, e.g.
+    python -m Code.Data.peakbench Data/randomsdy/*.sdy --methods scipy peakutils tony
+
+A reference peak counts as found if a method has a peak within --tolerance samples of it."""
+
+import sys
+import time
+import argparse
+
+import numpy as np
+
+from Code.Data import analysis
+from Code.Data.peaks import detect_peaks, METHODS, SAMPLE_FREQ
+
+REFERENCE_METHOD = 'peakutils'
+
+
+def synthetic_trace(seconds=600, heart_rate=70, noise=1.0, seed=0):
+    """An arterial pressure-like trace (mmHg, 0.1 mmHg resolution like the exports), with beat-to-beat variability"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * SAMPLE_FREQ)) / SAMPLE_FREQ
+    rate = heart_rate / 60 * (1 + 0.05 * np.sin(2 * np.pi * 0.1 * t))  # Respiratory variation
+    phase = 2 * np.pi * np.cumsum(rate) / SAMPLE_FREQ
+    trace = 80 + 40 * np.maximum(np.sin(phase), 0) ** 3 + 5 * np.sin(2 * phase) + rng.normal(0, noise, len(t))
+    return np.round(trace, 1)
+
+
+def synthetic_traces(seconds=600):
+    return {f"synthetic {heart_rate} bpm, noise {noise}": synthetic_trace(seconds, heart_rate, noise, seed=i_trace)
+            for i_trace, (heart_rate, noise) in enumerate(((50, 0.5), (70, 1.0), (100, 2.0), (140, 4.0)))}
+
+
+def study_traces(studypaths, channels=('pa', 'pd')):
+    traces = {}
+    for studypath in studypaths:
+        study = analysis.load_study(studypath)
+        for channel in channels:
+            traces[f"{studypath} {channel}"] = np.asarray(study.channel(channel), dtype=np.float64)
+    return traces
+
+
+def n_matched(reference, peaks, tolerance):
+    """How many of reference have a peak within tolerance samples"""
+    if not len(reference) or not len(peaks):
+        return 0
+    i_right = np.clip(np.searchsorted(peaks, reference), 0, len(peaks) - 1)
+    i_left = np.clip(i_right - 1, 0, None)
+    distance = np.minimum(np.abs(peaks[i_right] - reference), np.abs(peaks[i_left] - reference))
+    return int(np.sum(distance <= tolerance))
+
+
+def time_method(trace, method, repeats):
+    """(peaks, best time of repeats in seconds)"""
+    best = np.inf
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        peaks = detect_peaks(trace, method=method)
+        best = min(best, time.perf_counter() - t_start)
+    return peaks, best
+
+
+def benchmark(traces, methods=METHODS, tolerance=2, repeats=3):
+    """One row per trace & method: {'trace', 'method', 'n_peaks', 'seconds', 'msamples_per_s', 'recall',
+    'precision'}, recall & precision being against the REFERENCE_METHOD's peaks"""
+    rows = []
+    for name, trace in traces.items():
+        reference = detect_peaks(trace, method=REFERENCE_METHOD)
+        for method in methods:
+            peaks, seconds = time_method(trace, method, repeats)
+            rows.append({'trace': name,
+                         'method': method,
+                         'n_peaks': len(peaks),
+                         'seconds': seconds,
+                         'msamples_per_s': len(trace) / seconds / 1e6 if seconds else np.inf,
+                         'recall': n_matched(reference, peaks, tolerance) / len(reference) if len(reference) else 1.,
+                         'precision': n_matched(peaks, reference, tolerance) / len(peaks) if len(peaks) else 1.})
+    return rows
+
+
+def print_rows(rows, file=sys.stdout):
+    print(f"{'trace':<40} {'method':<10} {'peaks':>6} {'ms':>9} {'Msamples/s':>11} {'recall':>7} {'precision':>9}",
+          file=file)
+    for row in rows:
+        print(f"{row['trace'][-40:]:<40} {row['method']:<10} {row['n_peaks']:>6} {row['seconds'] * 1e3:>9.2f} "
+              f"{row['msamples_per_s']:>11.2f} {row['recall']:>7.3f} {row['precision']:>9.3f}", file=file)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m Code.Data.peakbench",
+                                     description=f"Benchmark the peak detection methods against {REFERENCE_METHOD}")
+    parser.add_argument('studies', nargs='*', help="Also benchmark on the Pa & Pd of these .txt/.sdy studies")
+    parser.add_argument('--methods', nargs='+', default=list(METHODS), choices=METHODS)
+    parser.add_argument('--seconds', type=float, default=600, help="Length of the synthetic traces (0 for none)")
+    parser.add_argument('--tolerance', type=int, default=2, help="Samples a peak may be off by and still agree")
+    parser.add_argument('--repeats', type=int, default=3, help="Time the best of this many runs")
+    args = parser.parse_args(argv)
+
+    traces = synthetic_traces(args.seconds) if args.seconds else {}
+    traces.update(study_traces(args.studies))
+    print_rows(benchmark(traces, methods=args.methods, tolerance=args.tolerance, repeats=args.repeats))
+
+
+if __name__ == "__main__":
+    main()
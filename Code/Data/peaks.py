@@ -0,0 +1,106 @@
+"""Peak (beat) detection - the one place the SDY/TXT readers, the plots and the ensembles find peaks.
+
+detect_peaks() takes a method:
+    'scipy'     scipy.signal.find_peaks - compiled, and the default
+    'peakutils' peakutils.indexes, which Cophy always used; its plateau handling and min_dist loop are pure Python
+    'cwt'       scipy.signal.find_peaks_cwt (slow; for comparison)
+    'tony'      Tony Beltramelli's RMS ratio detector, vectorised
+With the same thres & min_dist, 'scipy' finds the same peaks as 'peakutils' (barring the odd sample on a flat-topped or
+equal-height pair of peaks) - see peakbench.py, which measures this and the speed of each method."""
+
+import numpy as np
+import peakutils
+import scipy.signal as signal
+
+SAMPLE_FREQ = 200
+MIN_DIST = SAMPLE_FREQ // 2  # Max 120 bpm; the ensembles use their own, shorter, minimum RR
+THRESHOLD = 0.3  # Fraction of the way from the trace's min to its max a peak must reach (as peakutils)
+METHODS = ('scipy', 'peakutils', 'cwt', 'tony')
+DEFAULT_METHOD = 'scipy'
+RETRY_THRESHOLDS = (0.2, 0.05)
+MIN_PEAK_INTERVAL = SAMPLE_FREQ * 6  # If there's less than one peak per 6 s (10 bpm), retry with a lower threshold
+
+
+def detect_peaks(trace, method=DEFAULT_METHOD, min_dist=MIN_DIST, thres=THRESHOLD, prominence=None):
+    """Indices of the peaks of trace, at least min_dist samples apart (the higher peak wins), as an int64 array.
+    prominence (in the trace's units) is only used by the 'scipy' method. Raises ValueError for an unsigned trace, as
+    peakutils always has."""
+    trace = np.asarray(trace)
+    if np.issubdtype(trace.dtype, np.unsignedinteger):
+        raise ValueError("trace must be signed")
+    if len(trace) < 3:
+        return np.zeros(0, dtype=np.int64)
+    if method == 'scipy':
+        peaks = scipy_peaks(trace, min_dist, thres, prominence)
+    elif method == 'peakutils':
+        peaks = peakutils.indexes(trace, thres=thres, min_dist=int(min_dist))
+    elif method == 'cwt':
+        widths = [int(w) for w in np.linspace(min_dist, min_dist * 4, 4)]
+        peaks = signal.find_peaks_cwt(trace, widths=widths)
+    elif method == 'tony':
+        peaks = tony_peaks(trace)
+    else:
+        raise ValueError(f"method must be one of {METHODS}, not {method}")
+    return np.asarray(peaks, dtype=np.int64)
+
+
+def scipy_peaks(trace, min_dist, thres, prominence=None):
+    trace_min, trace_max = np.min(trace), np.max(trace)
+    if trace_min == trace_max:  # Flat
+        return np.zeros(0, dtype=np.int64)
+    height = thres * (trace_max - trace_min) + trace_min
+    # peakutils keeps peaks further than min_dist apart; scipy's distance is the smallest spacing allowed
+    peaks, _ = signal.find_peaks(trace, distance=int(min_dist) + 1, prominence=prominence)
+    return peaks[trace[peaks] > height]
+
+
+def tony_peaks(trace, threshold=0.5):
+    """https://github.com/MonsieurV/py-findpeaks/blob/master/tests/libs/tony_beltramelli_detect_peaks.py
+    Performs peak detection on three steps: root mean square, peak to average ratios and first order logic.
+    threshold used to discard peaks too small"""
+    root_mean_square = np.sqrt(np.mean(np.square(trace, dtype=np.float64)))
+    ratios = np.square(trace / root_mean_square)
+    peaks = (ratios > np.roll(ratios, 1)) & (ratios > np.roll(ratios, -1)) & (ratios > threshold)
+    return np.flatnonzero(peaks)
+
+
+def detect_beats(trace, method=DEFAULT_METHOD, min_dist=MIN_DIST, thresholds=(THRESHOLD,) + RETRY_THRESHOLDS):
+    """detect_peaks(), but if that finds fewer beats than expected for the trace's length (e.g. a damped or noisy
+    trace), tries again with each lower threshold in turn"""
+    min_peaks = len(trace) / MIN_PEAK_INTERVAL
+    for i_thres, thres in enumerate(thresholds):
+        peaks = detect_peaks(trace, method=method, min_dist=min_dist, thres=thres)
+        if len(peaks) >= min_peaks:
+            break
+        if i_thres + 1 < len(thresholds):
+            print(f"Found {len(peaks)} but expected at least {min_peaks} - using thresh {thresholds[i_thres + 1]} ->")
+    return peaks
+
+
+class BeatIndex:
+    """The peaks of one trace of a whole study, found once, with the RR intervals between them.
+
+    Regions (e.g. the ensembles) take their beats from between(), which detects them in just that region's samples - so
+    the height threshold is relative to the region, and a flush or zeroing artefact elsewhere in the recording can't
+    hide its beats. scipy does that faster than a region could be cut out of the whole-trace peaks with its own
+    threshold."""
+
+    def __init__(self, peaks, trace=None, min_dist=MIN_DIST, thres=THRESHOLD):
+        self.peaks = np.asarray(peaks, dtype=np.int64)
+        self.rr = np.diff(self.peaks)
+        self.trace = trace  # Needed by between()
+        self.min_dist = min_dist
+        self.thres = thres
+
+    @classmethod
+    def from_trace(cls, trace, method=DEFAULT_METHOD, min_dist=MIN_DIST):
+        return cls(detect_peaks(trace, method=method, min_dist=min_dist), trace=trace, min_dist=min_dist)
+
+    def __len__(self):
+        return len(self.peaks)
+
+    def between(self, i_from, i_to):
+        """(peaks, rr) for samples i_from <= peak < i_to - the peaks detect_peaks() finds in trace[i_from:i_to], as
+        indices of the whole trace; rr[i] is the interval from peaks[i] to peaks[i+1]"""
+        peaks = detect_peaks(self.trace[i_from:i_to], min_dist=self.min_dist, thres=self.thres) + i_from
+        return peaks, np.diff(peaks)
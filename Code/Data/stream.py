@@ -0,0 +1,123 @@
+"""Streams SDY recordings in fixed-size blocks of samples, so arbitrarily long recordings can be processed in bounded
+memory. Clipping and forward-filling carry their state across block boundaries, and the clipping thresholds come from
+a first, strided sampling pass over the memory-mapped file rather than from the whole recording.
+
+    blocks = iter_sdy_blocks("study.sdy", channels=('pa', 'pd'))
+    for peaks in stream_peaks(blocks, trace_name='pd'):
+        ...
+
+Each block is a (start, channels) tuple - start is the index of the block's first sample in the whole recording and
+channels is a dict of channel name -> 1D array."""
+
+import numpy as np
+
+from Code.Data.clip import SIGNAL_DTYPE, clip_threshold, clip_fill
+from Code.Data.peaks import detect_peaks
+from Code.Data.SDYFile import SDYFile, COLS, EXPECTED_SAMPLING_INTERVAL_MAX, SAMPLING_FREQ
+
+SUBSAMPLES_PER_ROW = len(COLS['pd'])
+DEFAULT_BLOCK_SAMPLES = SAMPLING_FREQ * 60  # 1 minute
+THRESHOLD_SAMPLE_ROWS = 100000  # Rows of the file read to estimate the clipping thresholds
+CLIPPED_CHANNELS = ('pd', 'pa')
+
+
+class ForwardFillClipper:
+    """Streaming equivalent of SDYFile.clip_wave, but with a fixed threshold; values above it are replaced by the last
+    good value, which is carried over from the previous block"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.last_value = np.nan
+
+    def __call__(self, wave):
+        wave = np.array(wave, dtype=SIGNAL_DTYPE)
+        if not len(wave):
+            return wave
+        clip_fill(wave, self.threshold, carry=self.last_value)
+        self.last_value = wave[-1]
+        return wave
+
+
+def sample_clip_thresholds(raw_study_data, pa_channel='pa_physio', clip_wave_quantile=0.9, clip_wave_n_quantiles=1.5,
+                           max_rows=THRESHOLD_SAMPLE_ROWS):
+    """First pass - estimates the Pd and Pa thresholds from evenly strided rows of the recording. As in SDYFile, Pa is
+    clipped against the (already clipped) Pd"""
+    step = max(1, len(raw_study_data) // max_rows)
+    rows = np.array(raw_study_data[::step, COLS['pd'] + COLS[pa_channel]])
+    pd_sample = rows[:, :len(COLS['pd'])].ravel().astype(SIGNAL_DTYPE)
+    pd_threshold = clip_threshold(pd_sample, clip_wave_quantile, clip_wave_n_quantiles)
+    pd_sample = clip_fill(pd_sample, pd_threshold)
+    pa_threshold = clip_threshold(pd_sample, clip_wave_quantile, clip_wave_n_quantiles)
+    return {'pd': pd_threshold, 'pa': pa_threshold}
+
+
+def iter_sdy_blocks(filepath, channels=('pa', 'pd'), pa_channel='pa_physio', block_samples=DEFAULT_BLOCK_SAMPLES,
+                    clip_wave_quantile=0.9, clip_wave_n_quantiles=1.5, thresholds=None):
+    """Yields (start, {channel: samples}) for consecutive blocks of about block_samples samples (rounded to whole rows).
+    Pd and Pa are clipped & forward-filled as SDYFile does; other channels are converted to float as they are"""
+    with open(filepath, 'rb') as f:
+        SDYFile.read_study_info(f)
+        offset = f.tell()
+    raw_study_data = SDYFile.map_study_data(filepath, offset=offset)
+    if thresholds is None:
+        thresholds = sample_clip_thresholds(raw_study_data, pa_channel=pa_channel,
+                                            clip_wave_quantile=clip_wave_quantile,
+                                            clip_wave_n_quantiles=clip_wave_n_quantiles)
+    clippers = {channel: ForwardFillClipper(thresholds[channel]) for channel in CLIPPED_CHANNELS}
+
+    rows_per_block = max(1, block_samples // SUBSAMPLES_PER_ROW)
+    for row_from in range(0, len(raw_study_data), rows_per_block):
+        rows = raw_study_data[row_from:row_from + rows_per_block]
+        block = {}
+        for channel in channels:
+            source = pa_channel if channel == 'pa' else channel
+            wave = np.array(rows[:, COLS[source]]).ravel()
+            if channel in clippers:
+                block[channel] = clippers[channel](wave)
+            else:
+                block[channel] = wave.astype(SIGNAL_DTYPE)
+        yield row_from * SUBSAMPLES_PER_ROW, block
+
+
+def stream_peaks(blocks, trace_name='pd', min_dist=EXPECTED_SAMPLING_INTERVAL_MAX):
+    """Pipeline stage - yields arrays of peak indices (into the whole recording) as blocks arrive.
+
+    Each block is searched together with the last 2 * min_dist samples of the previous one, and peaks within min_dist
+    of the end of a block are held back until the next block shows whether there's a bigger one just after them."""
+    tail, tail_start = np.zeros(0), 0
+    emitted_upto, last_peak = 0, None
+    block_end = 0
+    for start, block in blocks:
+        trace = np.concatenate((tail, block[trace_name]))
+        trace_start = start - len(tail)
+        block_end = start + len(block[trace_name])
+        peaks = _window_peaks(trace, trace_start, min_dist)
+        ready = peaks[(peaks >= emitted_upto) & (peaks < block_end - min_dist)]
+        ready, last_peak = _drop_close(ready, last_peak, min_dist)
+        if len(ready):
+            yield ready
+        emitted_upto = max(emitted_upto, block_end - min_dist)
+        tail = trace[-2 * min_dist:]
+        tail_start = block_end - len(tail)
+
+    # Whatever was held back from the final block
+    peaks = _window_peaks(tail, tail_start, min_dist)
+    remaining, last_peak = _drop_close(peaks[peaks >= emitted_upto], last_peak, min_dist)
+    if len(remaining):
+        yield remaining
+
+
+def _window_peaks(trace, trace_start, min_dist):
+    if len(trace) < 3:
+        return np.zeros(0, dtype=np.int64)
+    return detect_peaks(trace, min_dist=int(min_dist)) + trace_start
+
+
+def _drop_close(peaks, last_peak, min_dist):
+    """Drops peaks too close to the last one already emitted (which can happen either side of a block boundary)"""
+    kept = []
+    for peak in peaks:
+        if last_peak is None or peak - last_peak >= min_dist:
+            kept.append(peak)
+            last_peak = peak
+    return np.array(kept, dtype=np.int64), last_peak
@@ -0,0 +1,159 @@
+"""An in-process cache of opened studies, so going back to a study (e.g. between the vessels of one patient) doesn't
+parse it again.
+
+Each entry holds the study object (with its decoded channels and beat indexes), the level-of-detail pyramids of its
+traces, and the beat-wise series derived from it. Entries are kept in least recently used order; once their estimated
+size exceeds the memory budget, the least recently used are evicted (though never the most recent, however big). An
+entry is dropped if its file has changed since it was opened.
+
+Swapping an SDY study's Pa channel (use_labels) keeps the entry, only dropping what was derived from the old Pa."""
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from Code.Data import analysis
+
+DEFAULT_BUDGET_BYTES = 1024 ** 3
+
+
+def nbytes(value):
+    """Size of the arrays in value (nested dicts, lists & tuples of them)"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(item) for item in value)
+    return 0
+
+
+def study_nbytes(study):
+    """Estimated memory held by a study - its DataFrame (TxtFile, whose channels are views of it) or its decoded
+    channels (SDYFile, whose df only decodes on demand), and its beat indexes"""
+    if hasattr(study.df, 'memory_usage'):
+        size = int(study.df.memory_usage(index=False).sum())
+    else:
+        size = nbytes(study.channels)
+    return size + sum(beat_index.peaks.nbytes + beat_index.rr.nbytes for beat_index in study.beat_indexes.values())
+
+
+class CachedStudy:
+    def __init__(self, studypath, study):
+        self.studypath = studypath
+        self.study = study
+        self.pyramids = {}  # Channel -> EnvelopePyramid
+        self.derived = {}  # Panel -> {series name: {'x', 'y'}}
+        self.stat = file_stat(studypath)
+        self.lock = threading.Lock()  # Held by whichever loader is working on the study
+
+    def nbytes(self):
+        pyramids = sum(nbytes(pyramid.levels) for pyramid in self.pyramids.values())  # x & y are the study's own
+        return study_nbytes(self.study) + pyramids + nbytes(self.derived)
+
+    def use_labels(self, labels):
+        """Switches an SDY study to the labels' Pa channel, if it isn't already on it - dropping only what was derived
+        from the old one"""
+        if not hasattr(self.study, 'pa_channel'):
+            return
+        pa_channel = analysis.pa_channel_from_labels(labels)
+        if pa_channel != self.study.pa_channel:
+            self.study.pa_channel = pa_channel
+            self.pyramids.pop('pa', None)
+            self.derived.clear()
+
+
+def file_stat(studypath):
+    stat = os.stat(studypath)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class StudyCache:
+    def __init__(self, budget_bytes=DEFAULT_BUDGET_BYTES):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()  # Study path -> CachedStudy, least recently used first
+        self.sizes = {}  # Study path -> estimated bytes, as of the last resize()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, studypath):
+        return studypath in self.entries
+
+    def get(self, studypath):
+        """The CachedStudy for studypath (now the most recently used), or None if it isn't cached or has changed"""
+        with self.lock:
+            entry = self.entries.get(studypath)
+            if entry is not None:
+                try:
+                    current = entry.stat == file_stat(studypath)
+                except OSError:
+                    current = False
+                if not current:
+                    self.remove(studypath)
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(studypath)
+            return entry
+
+    def open(self, studypath, labels=None):
+        """The cached study for studypath, opening (and caching) it if need be - with its Pa channel as in labels"""
+        entry = self.get(studypath)
+        if entry is None:
+            entry = CachedStudy(studypath, analysis.load_study(studypath, labels))
+            with self.lock:
+                self.entries[studypath] = entry
+            self.resize(studypath)
+        return entry
+
+    def resize(self, studypath):
+        """Re-estimates the size of studypath's entry (call after adding to it), evicting others to fit the budget"""
+        with self.lock:
+            if studypath in self.entries:
+                self.sizes[studypath] = self.entries[studypath].nbytes()
+            while self.nbytes() > self.budget_bytes and len(self.entries) > 1:
+                lru_path = next(iter(self.entries))
+                if lru_path == studypath:  # Evict others before the one just used
+                    self.entries.move_to_end(lru_path)
+                    lru_path = next(iter(self.entries))
+                self.remove(lru_path)
+                self.evictions += 1
+
+    def remove(self, studypath):
+        self.entries.pop(studypath, None)
+        self.sizes.pop(studypath, None)
+
+    def invalidate(self, studypath):
+        with self.lock:
+            self.remove(studypath)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+
+    def nbytes(self):
+        return sum(self.sizes.values())
+
+    def stats(self):
+        n_lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / n_lookups if n_lookups else 0.,
+                'n_studies': len(self.entries),
+                'nbytes': self.nbytes(),
+                'budget_bytes': self.budget_bytes}
+
+    def __repr__(self):
+        stats = self.stats()
+        return (f"StudyCache({stats['n_studies']} studies, {stats['nbytes'] / 1024 ** 2:.0f}/"
+                f"{stats['budget_bytes'] / 1024 ** 2:.0f} MB, {stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['evictions']} evicted)")
@@ -0,0 +1,147 @@
+"""Mapping between times (s) and sample indices of a study's (or an ensemble's) time axis.
+
+Recordings are sampled at a fixed rate, so for almost every time axis the nearest sample to a time is just
+round((time - t0) / dt) - O(1), with no search. Time axes which aren't evenly spaced (e.g. a TXT export with dropped or
+irregular timestamps) fall back to a searchsorted, with each lookup cached as the same markers are looked up repeatedly.
+Either way the index returned is the one find_nearest() always gave.
+
+Where the rate is known up front (SDY files), a SampleClock stands in for the time axis altogether - it computes time
+stamps as they're asked for, so there's no time column to store."""
+
+import math
+import operator
+from datetime import timedelta
+
+import numpy as np
+
+UNIFORM_TOLERANCE = 0.25  # Samples may be this fraction of an interval off an even grid and still count as uniform
+
+
+class TimeIndex:
+    def __init__(self, time):
+        """time must be ascending"""
+        self.time = np.asarray(time)
+        self.n_samples = len(self.time)
+        self.t0, self.dt = None, None
+        self.uniform = False
+        self._lookups = {}  # Time -> index, for the non-uniform path
+        if self.n_samples >= 2:
+            t0, t_end = float(self.time[0]), float(self.time[-1])
+            dt = (t_end - t0) / (self.n_samples - 1)
+            if dt > 0:
+                grid = np.arange(self.n_samples, dtype=np.float64)
+                grid *= dt
+                grid += t0
+                grid -= self.time
+                if np.nanmax(np.abs(grid)) <= UNIFORM_TOLERANCE * dt:
+                    self.t0, self.dt, self.uniform = t0, dt, True
+
+    def __len__(self):
+        return self.n_samples
+
+    def index(self, time):
+        """The index of the sample nearest to time (the later sample if it's halfway between two) - clipped to the
+        axis, as find_nearest()"""
+        if not self.uniform:
+            if time not in self._lookups:
+                self._lookups[time] = find_nearest(self.time, time)
+            return self._lookups[time]
+        guess = min(max(int(round((time - self.t0) / self.dt)), 0), self.n_samples - 1)
+        # The grid is only approximately the axis, so check the neighbouring samples against the actual times
+        i_best = guess
+        for i in (guess - 1, guess + 1):
+            if 0 <= i < self.n_samples:
+                distance, best_distance = math.fabs(time - self.time[i]), math.fabs(time - self.time[i_best])
+                if distance < best_distance or (distance == best_distance and i > i_best):
+                    i_best = i
+        return i_best
+
+    def time_at(self, index):
+        return float(self.time[index])
+
+    def slice(self, time_from, time_to):
+        """The samples from the one nearest time_from up to (not including) the one nearest time_to"""
+        return slice(self.index(time_from), self.index(time_to))
+
+
+class SampleClock:
+    """The time axis of a recording sampled at a fixed rate: sample i is at i / sample_freq s from the start (and so at
+    start + that, if the start datetime is known). Indexing it (with an int, slice or index array) gives the float64
+    time stamps asked for, computed on the spot - np.asarray() of it gives the whole axis. It can be used wherever a
+    TimeIndex can.
+
+    samples_per_row is the layout of the file the samples came from - e.g. an SDY row holds 4 consecutive samples of
+    each channel, so sample i is sub-sample i % 4 of row i // 4."""
+
+    uniform = True
+    t0 = 0.
+
+    def __init__(self, n_samples, sample_freq, start=None, samples_per_row=1):
+        self.n_samples = int(n_samples)
+        self.sample_freq = sample_freq
+        self.dt = 1 / sample_freq
+        self.start = start  # A datetime, or None if unknown
+        self.samples_per_row = samples_per_row
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return np.arange(*index.indices(self.n_samples), dtype=np.float64) / self.sample_freq
+        if np.ndim(index) == 0:
+            i = operator.index(index)
+            if not -self.n_samples <= i < self.n_samples:
+                raise IndexError(f"index {i} is out of bounds for a clock of {self.n_samples} samples")
+            return (i % self.n_samples) / self.sample_freq
+        indices = np.asarray(index)
+        if indices.dtype == bool:
+            indices = np.flatnonzero(indices)
+        if len(indices) and not (-self.n_samples <= indices.min() and indices.max() < self.n_samples):
+            raise IndexError(f"index out of bounds for a clock of {self.n_samples} samples")
+        return np.where(indices < 0, indices + self.n_samples, indices) / self.sample_freq
+
+    def __array__(self, dtype=None, copy=None):
+        time = self[:]
+        return time if dtype is None else time.astype(dtype)
+
+    def time_at(self, index):
+        return self[index]
+
+    def datetime_at(self, index):
+        if self.start is None:
+            return None
+        return self.start + timedelta(seconds=self.time_at(index))
+
+    def row(self, index):
+        """(row, sub-sample) of the file the sample at index was stored in"""
+        return divmod(index, self.samples_per_row)
+
+    def searchsorted(self, time, side='left'):
+        """As np.searchsorted() on the time stamps"""
+        after = operator.ge if side == 'left' else operator.gt
+        i = min(max(math.ceil(time * self.sample_freq), 0), self.n_samples)
+        while i > 0 and after((i - 1) / self.sample_freq, time):  # Correct the guess - it's at most a sample out
+            i -= 1
+        while i < self.n_samples and not after(i / self.sample_freq, time):
+            i += 1
+        return i
+
+    def index(self, time):
+        """As TimeIndex.index(), but with no time axis to look at"""
+        idx = self.searchsorted(time)
+        if idx > 0 and (idx == self.n_samples or
+                        math.fabs(time - (idx - 1) / self.sample_freq) < math.fabs(time - idx / self.sample_freq)):
+            return idx - 1
+        return idx
+
+    def slice(self, time_from, time_to):
+        return slice(self.index(time_from), self.index(time_to))
+
+
+def find_nearest(array, value):
+    idx = np.searchsorted(array, value, side="left")
+    if idx > 0 and (idx == len(array) or math.fabs(value - array[idx - 1]) < math.fabs(value - array[idx])):
+        return idx - 1
+    else:
+        return idx
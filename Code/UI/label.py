@@ -1,19 +1,18 @@
 import os
 import sys
-import pickle
 import traceback
 import numpy as np
 import pandas as pd
 import pyqtgraph as pg
-from glob import glob
 
 from PyQt5 import QtCore, QtWidgets
 
-from Code.Data import plots
-import Code.Data.calculations as c
-from Code.Data.TxtFile import TxtFile
+from Code.Data import metrics, analysis, labelstore, folderindex
+from Code.Data.calculations import CHANNEL_INDEX
+from Code.Data.studycache import StudyCache
 from Code.Data.SDYFile import SDYFile
 from Code.UI.layout_label import Ui_MainWindow
+from Code.UI.loader import LoadToken, StudyLoader, LabelSaver, FolderExporter
 
 if QtCore.QT_VERSION >= 0x50501:
     def excepthook(type_, value, traceback_):
@@ -23,10 +22,10 @@ if QtCore.QT_VERSION >= 0x50501:
 
     sys.excepthook = excepthook
 
-SAMPLE_FREQ = 200
-PD_OFFSET_TIME = 0.05
-PD_OFFSET_POINT = int(PD_OFFSET_TIME * SAMPLE_FREQ)
 PLOT_PEAKS = True
+CALCULATION_DELAY_MS = 50  # Slider events within this long of each other are handled by one recalculation
+SAVE_DELAY_MS = 1000  # Labels are saved once they've stopped changing for this long
+STUDY_CACHE_MB = 1024  # Recently opened studies (with their plots' data) are kept, up to this much, to switch back to
 
 class LabelledLinearRegionItem(pg.LinearRegionItem):
     def __init__(self, values, movable, label):
@@ -52,8 +51,32 @@ class LabelUI(Ui_MainWindow):
         self.studyData = dict()
         self.TxtSdyFile = None
         self.calculations = dict()
-
-        with open("./information.txt", 'r') as f:
+        self.load_token, self.loader = None, None
+        self.exporter = None
+        self.study_cache = StudyCache(budget_bytes=STUDY_CACHE_MB * 1024 ** 2)
+        self.pyramids = dict()
+        self.traces = []  # (curve, EnvelopePyramid) of each raw trace, redrawn at the right detail for the view
+        self.threadpool = QtCore.QThreadPool.globalInstance()
+        self.savepool = QtCore.QThreadPool()
+        self.savepool.setMaxThreadCount(1)  # So saves of the same study can't overtake each other
+        self.calculation_timer = QtCore.QTimer()
+        self.calculation_timer.setSingleShot(True)
+        self.calculation_timer.setInterval(CALCULATION_DELAY_MS)
+        self.calculation_timer.timeout.connect(self.scheduled_calculations)
+        self.save_timer = QtCore.QTimer()
+        self.save_timer.setSingleShot(True)
+        self.save_timer.setInterval(SAVE_DELAY_MS)
+        self.save_timer.timeout.connect(self.save_labels_async)
+        self.save_pending = False  # Whether the scheduled recalculation should be followed by a save
+        self.syncing_sliders = False  # Set while adjust_all_sliders_in_group() moves the rest of a group
+        self.folder_index = None
+        self.folder_watcher = QtCore.QFileSystemWatcher()
+        self.folder_watcher.directoryChanged.connect(self.update_study_list)
+        self.folder_watcher.fileChanged.connect(self.update_study_list)
+        if QtWidgets.QApplication.instance():
+            QtWidgets.QApplication.instance().aboutToQuit.connect(self.flush_pending)
+
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "information.txt"), 'r') as f:
             self.textBrowser.setHtml("\n".join(f.readlines()))
 
         self.plot_pressure, self.plot_flow, self.plot_pressure_ratios = None, None, None
@@ -71,20 +94,13 @@ class LabelUI(Ui_MainWindow):
             self.comboBox_txtsdyFiles.setEnabled(True)
             self.label_PatientID.setText(f"Patient ID: {self.studyData.get('id', 'NA')}")
 
-            # Get rid of the old files list and add the new ones
+            # Get rid of the old files list and add the new ones; from then on, they're kept up to date as files change
+            if self.folder_watcher.files() or self.folder_watcher.directories():
+                self.folder_watcher.removePaths(self.folder_watcher.files() + self.folder_watcher.directories())
+            self.folder_index = folderindex.FolderIndex(self.studyFolderPath)
+            self.folder_watcher.addPath(self.studyFolderPath)
             self.comboBox_txtsdyFiles.clear()
-            self.comboBox_txtsdyFiles.addItem("Please select a file")
-
-            txt_file_paths = glob(os.path.join(self.studyFolderPath, "*.txt"))
-            sdy_file_paths = glob(os.path.join(self.studyFolderPath, "*.sdy"))
-            for txt_file_path in txt_file_paths:
-                labels = self.load_cph(f"{txt_file_path}.cph")
-                labels.pop('pa', None)  # Remove the PA key so doesn't count as a label
-                self.comboBox_txtsdyFiles.addItem("{} - {} labels".format(txt_file_path, len(labels)))
-            for sdy_file_path in sdy_file_paths:
-                labels = self.load_cph(f"{sdy_file_path}.cph")
-                labels.pop('pa', None)  # Remove the PA key so doesn't count as a label
-                self.comboBox_txtsdyFiles.addItem("{} - {} labels".format(sdy_file_path, len(labels)))
+            self.update_study_list()
 
             # Clear the plot window
             self.GraphicsLayout = pg.GraphicsLayout()
@@ -93,16 +109,55 @@ class LabelUI(Ui_MainWindow):
         else:  # If a study folder path isn't set, the file box shouldn't be clickable
             self.comboBox_txtsdyFiles.setEnabled(False)
 
+    def update_study_list(self, changed_path=None):
+        """Rescans the folder (reading only new or changed studies) and updates the file list if anything changed,
+        keeping the selected file selected"""
+        if not self.folder_index:
+            return
+        self.folder_index.scan()
+        store_path = os.path.join(self.folder_index.folder, labelstore.STORE_FILENAME)
+        if os.path.exists(store_path) and store_path not in self.folder_watcher.files():
+            self.folder_watcher.addPath(store_path)  # Also needed again after it's been replaced by a compaction
+        label_counts = labelstore.open_store(self.folder_index.folder).counts()
+        items = ["Please select a file"]
+        for file_path in self.folder_index.study_paths():
+            items.append("{} - {} labels".format(file_path, label_counts.get(os.path.basename(file_path), 0)))
+        current_items = [self.comboBox_txtsdyFiles.itemText(i) for i in range(self.comboBox_txtsdyFiles.count())]
+        if items == current_items:
+            return
+        selected_path = self.comboBox_txtsdyFiles.currentText().rsplit(' ', 3)[0]
+        self.comboBox_txtsdyFiles.blockSignals(True)
+        self.comboBox_txtsdyFiles.clear()
+        self.comboBox_txtsdyFiles.addItems(items)
+        for i_item, item in enumerate(items):
+            if item.rsplit(' ', 3)[0] == selected_path:
+                self.comboBox_txtsdyFiles.setCurrentIndex(i_item)
+        self.comboBox_txtsdyFiles.blockSignals(False)
+
     def load_study_folder(self):
         self.studyFolderPath = QtWidgets.QFileDialog.getExistingDirectory(None, "Select a folder", "./data/",
                                                                           QtWidgets.QFileDialog.ShowDirsOnly)
         self.refresh_ui()
 
     def toggle_pa(self):
-        self.save_cph()
+        """Saves the new Pa choice and reloads - the study comes back from the study cache with just Pa decoded again"""
+        self.save_labels()
         self.load_txtsdyFile()
 
+    def flush_pending(self):
+        """Saves now if a save is waiting on a timer (e.g. before switching file, or quitting)"""
+        self.calculation_timer.stop()
+        if self.TxtSdyFile and (self.save_pending or self.save_timer.isActive()):
+            self.save_labels()
+        self.savepool.waitForDone()
+
     def load_txtsdyFile(self):
+        """Starts loading the selected study in the background, cancelling any load still in progress. The raw traces
+        are drawn once it's parsed (on_study_loaded), and the PdPa & resistance panels as they're computed (on_derived)"""
+        if self.load_token:
+            self.load_token.cancel()
+        if self.TxtSdyFile:
+            self.flush_pending()
         self.studyFolderPath = None
         self.studyData = dict()
         self.TxtSdyFile = None
@@ -116,26 +171,59 @@ class LabelUI(Ui_MainWindow):
         self.slider_enddiastole_rest, self.slider_enddiastole_hyp = None, None
 
         study_path = self.comboBox_txtsdyFiles.currentText().rsplit(' ', 3)[0]
-        try:
-            if os.path.splitext(study_path)[-1] == ".txt":
-                self.TxtSdyFile = TxtFile(studypath=study_path, pd_offset=PD_OFFSET_POINT)
-                self.checkBox_Pa.setEnabled(False)
-            elif os.path.splitext(study_path)[-1] == ".sdy":
-                pa_channel = 'pa_physio' if self.checkBox_Pa.isChecked() else 'pa_trans'
-                self.TxtSdyFile = SDYFile(filepath=study_path, pa_channel=pa_channel)
-                self.checkBox_Pa.setEnabled(True)
-            self.label_PatientID.setText(f"Patient ID:\t{self.TxtSdyFile.patient_id}")
-            self.label_StudyDate.setText(f"Study date:\t{self.TxtSdyFile.study_date}")
-            self.label_ExportDate.setText(f"Export date:\t{self.TxtSdyFile.export_date}")
-        except FileNotFoundError:
-            print(f"!!!UNABLE TO FIND FILE {study_path}!!!")
+        self.clear_layout(self.verticalLayout_Buttons)  # Nothing to label until the new study arrives
+        self.checkBox_Pa.setEnabled(False)
+        self.GraphicsLayout = pg.GraphicsLayout()
+        self.graphicsView_.setCentralItem(self.GraphicsLayout)
+        self.label_PatientID.setText(f"Loading {os.path.basename(study_path)}...")
+        self.label_StudyDate.setText("")
+        self.label_ExportDate.setText("")
+
+        self.load_token = LoadToken(study_path)
+        self.loader = StudyLoader(self.load_token, self.study_cache)
+        self.loader.signals.loaded.connect(self.on_study_loaded)
+        self.loader.signals.derived.connect(self.on_derived)
+        self.loader.signals.failed.connect(self.on_load_failed)
+        self.threadpool.start(self.loader)
+
+    def on_study_loaded(self, token, study, labels, pyramids):
+        if token is not self.load_token:  # Superseded by another file
+            return
+        self.TxtSdyFile = study
+        self.pyramids = pyramids
+        stats = self.study_cache.stats()
+        self.statusbar.showMessage(f"Study cache: {stats['n_studies']} studies, {stats['nbytes'] / 1024 ** 2:.0f} MB "
+                                   f"({stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evicted)")
+        self.checkBox_Pa.setEnabled(type(study) == SDYFile)
+        self.label_PatientID.setText(f"Patient ID:\t{self.TxtSdyFile.patient_id}")
+        self.label_StudyDate.setText(f"Study date:\t{self.TxtSdyFile.study_date}")
+        self.label_ExportDate.setText(f"Export date:\t{self.TxtSdyFile.export_date}")
 
         self.plot_txtsdyFile()
         self.draw_buttons()
-        self.load_saved_labels()
+        self.load_saved_labels(labels)
         self.perform_calculations()
 
+    def on_derived(self, token, panel, series):
+        if token is not self.load_token:
+            return
+        if panel == 'pressure_ratios':
+            self.plot_pressure_ratio_series(series)
+        elif panel == 'resistances':
+            self.plot_resistance_series(series)
+        else:
+            raise ValueError(f"Unknown panel {panel}")
+
+    def on_load_failed(self, token, exception):
+        if token is not self.load_token:
+            return
+        if self.TxtSdyFile is None:  # Otherwise it was loaded, and only a beat-wise panel failed
+            self.label_PatientID.setText(f"Unable to load {os.path.basename(token.studypath)}")
+        if isinstance(exception, FileNotFoundError):
+            print(f"!!!UNABLE TO FIND FILE {token.studypath}!!!")
+
     def plot_txtsdyFile(self):
+        """Lays out the panels and draws the raw traces; the beat-wise panels are filled in by on_derived()"""
         pg.setConfigOptions(antialias=True)
 
         self.GraphicsLayout = pg.GraphicsLayout()
@@ -148,17 +236,8 @@ class LabelUI(Ui_MainWindow):
         # data_pa = self.clip_wave(np.array(self.TxtSdyFile.df['pa'], dtype=np.float))
         # data_pd = self.clip_wave(np.array(self.TxtSdyFile.df['pd'], dtype=np.float),
         #                          ref_wave=np.array(self.TxtSdyFile.df['pa'], dtype=np.float))
-        data_pa = np.array(self.TxtSdyFile.df['pa'])
-        data_pd = np.array(self.TxtSdyFile.df['pd'])
-        data_time = np.array(self.TxtSdyFile.df['time'])
-        data_flow = np.array(self.TxtSdyFile.df['flow'])
-        data_pdpa = plots.pdpa(self, peaks=self.TxtSdyFile.peaks)
-
-        data_pdpa_filtered = plots.pdpa_filtered(self, pdpa=data_pdpa)
-        data_microvascular_resistance = plots.microvascular_resistance(self, peaks=self.TxtSdyFile.peaks)
-        data_microvascular_resistance_filtered = plots.filtered_resistance(data_microvascular_resistance)
-        data_stenosis_resistance = plots.stenosis_resistance(self, peaks=self.TxtSdyFile.peaks)
-        data_stenosis_resistance_filtered = plots.filtered_resistance(data_stenosis_resistance)
+        data_pd = self.TxtSdyFile.channel('pd')
+        data_time = self.TxtSdyFile.time
 
         # Plots
         self.plot_pressure = self.GraphicsLayout.addPlot(row=0, col=0, colspan=2, title='Pressure')
@@ -173,14 +252,41 @@ class LabelUI(Ui_MainWindow):
         for p in (self.plot_flow, self.plot_pressure_ratios, self.plot_resistances):
             p.setXLink(self.plot_pressure)
 
-        # Lines
-        self.plot_pressure.plot(x=data_time, y=data_pa, name='Pa', pen='r')
-        self.plot_pressure.plot(x=data_time, y=data_pd, name='Pd', pen='y')
-        self.plot_flow.plot(x=data_time, y=data_flow, name='Flow', pen='g')
+        # Lines - drawn from the envelope pyramids at a detail to suit the view, and redrawn whenever it's panned/zoomed
+        self.traces = []
+        for p, channel, name, pen in ((self.plot_pressure, 'pa', 'Pa', 'r'),
+                                      (self.plot_pressure, 'pd', 'Pd', 'y'),
+                                      (self.plot_flow, 'flow', 'Flow', 'g')):
+            self.traces.append((p.plot(name=name, pen=pen), self.pyramids[channel]))
+        self.update_traces(self.plot_pressure.getViewBox(), (data_time[0], data_time[-1]))
+        self.plot_pressure.sigXRangeChanged.connect(self.update_traces)  # The other plots are X-linked to this one
+
+        # ECG gating indicators
+        if PLOT_PEAKS:
+            peak_times = data_time[self.TxtSdyFile.peaks]
+            self.plot_pressure.plot(x=peak_times, y=np.repeat(np.nanmax(data_pd), len(self.TxtSdyFile.peaks)),
+                                    pen=(200, 200, 200),
+                                    symbolBrush=(255, 0, 0),
+                                    symbolPen='w')
+
+    def update_traces(self, viewbox, x_range):
+        n_pixels = max(int(viewbox.width()), 100)  # Width is 0 before the plot is first shown
+        for curve, pyramid in self.traces:
+            x, y = pyramid.view(x_range[0], x_range[1], n_pixels)
+            curve.setData(x=x, y=y)
+
+    def plot_pressure_ratio_series(self, series):
+        data_pdpa, data_pdpa_filtered = series['pdpa'], series['pdpa_filtered']
         self.plot_pressure_ratios.plot(x=data_pdpa['x'], y=data_pdpa['y'], name='PdPa (beat-wise)',
                                        pen=(255, 255, 0, 100))
         self.plot_pressure_ratios.plot(x=data_pdpa_filtered['x'], y=data_pdpa_filtered['y'], name='PdPa (filtered)',
                                        pen=(255, 255, 0, 200))
+
+    def plot_resistance_series(self, series):
+        data_microvascular_resistance = series['microvascular']
+        data_microvascular_resistance_filtered = series['microvascular_filtered']
+        data_stenosis_resistance = series['stenosis']
+        data_stenosis_resistance_filtered = series['stenosis_filtered']
         self.plot_resistances.plot(x=data_microvascular_resistance['x'],
                                    y=data_microvascular_resistance['y'],
                                    name='Microvascular (beat-wise)',
@@ -198,14 +304,6 @@ class LabelUI(Ui_MainWindow):
                                    name='Stenosis (filtered)',
                                    pen=(255, 0, 255, 200))
 
-        # ECG gating indicators
-        if PLOT_PEAKS:
-            peak_times = np.array([data_time[peak] for peak in self.TxtSdyFile.peaks])
-            self.plot_pressure.plot(x=peak_times, y=np.repeat(max(data_pd), len(self.TxtSdyFile.peaks)),
-                                    pen=(200, 200, 200),
-                                    symbolBrush=(255, 0, 0),
-                                    symbolPen='w')
-
     def click_button(self, btn):
         if btn.slider_active:
             btn.slider_active = False
@@ -228,12 +326,12 @@ class LabelUI(Ui_MainWindow):
         else:
             print(f"Unknown button clicked!")
 
-        self.perform_calculations(save=True)  # Save in case something removed; if added OK as not placed yet
+        self.schedule_calculations(save=True)  # Save in case something removed; if added OK as not placed yet
 
     def create_marker(self, marker_type, value=None):
         slider = pg.InfiniteLine(pos=0.2, movable=True, label='',
                                  labelOpts={'position': 0.5, 'rotateAxis': (1, 0), 'anchor': (1, 1)})
-        slider.sigPositionChangeFinished.connect(lambda: self.perform_calculations(save=True))
+        slider.sigPositionChangeFinished.connect(lambda: self.schedule_calculations(save=True))
         if value:
             slider.setValue(value)
         if marker_type == 'notch_rest':
@@ -307,16 +405,16 @@ class LabelUI(Ui_MainWindow):
             self.slider_group_rest = []
         elif rest_or_hyp == 'hyp':
             self.slider_group_hyp = []
-        self.perform_calculations()
 
-    def draw_buttons(self):
-        def clear_layout(layout):
-            for i in reversed(range(layout.count())):
-                try:
-                    layout.itemAt(i).widget().setParent(None)
-                except AttributeError:
-                    pass
+    @staticmethod
+    def clear_layout(layout):
+        for i in reversed(range(layout.count())):
+            try:
+                layout.itemAt(i).widget().setParent(None)
+            except AttributeError:
+                pass
 
+    def draw_buttons(self):
         def initialise_button(labelui, text):
             btn = QtWidgets.QPushButton(labelui.centralwidget)
             btn.setText(text)
@@ -326,7 +424,7 @@ class LabelUI(Ui_MainWindow):
             self.verticalLayout_Buttons.addWidget(btn)
             return btn
 
-        clear_layout(self.verticalLayout_Buttons)
+        self.clear_layout(self.verticalLayout_Buttons)
 
         self.button_rest = initialise_button(self, 'Rest')
         self.button_hyp = initialise_button(self, 'Hyperaemia')
@@ -336,6 +434,8 @@ class LabelUI(Ui_MainWindow):
         self.button_enddiastole_hyp = initialise_button(self, 'End diastole (hyperaemia)')
 
     def adjust_all_sliders_in_group(self, slider, slider_group):
+        if self.syncing_sliders:  # Just one of the sliders being moved below to match
+            return
         slider_min, slider_max = slider.getRegion()
         if slider_group == 'rest':
             slider_group = self.slider_group_rest
@@ -343,265 +443,40 @@ class LabelUI(Ui_MainWindow):
             slider_group = self.slider_group_hyp
         else:
             raise ValueError(f"Unknown slider group")
-        for s in slider_group:
-            if s.getRegion() != (slider_min, slider_max):  # Only move if needed
-                s.setRegion((slider_min, slider_max))
-        self.perform_calculations(save=True)
-
-    def calculate_ensemble(self, rest_or_hyp):
+        self.syncing_sliders = True
+        try:
+            for s in slider_group:
+                if s.getRegion() != (slider_min, slider_max):  # Only move if needed
+                    s.setRegion((slider_min, slider_max))
+        finally:
+            self.syncing_sliders = False
+        self.schedule_calculations(save=True)
+
+    def plot_ensemble(self, rest_or_hyp):
         if rest_or_hyp == 'rest':
             plot = self.plot_ensemble_rest
+            ensemble_data = self.ensemble_data_rest
             slider_notch = self.slider_notch_rest
             slider_enddiastole = self.slider_enddiastole_rest
         elif rest_or_hyp == 'hyp':
             plot = self.plot_ensemble_hyp
+            ensemble_data = self.ensemble_data_hyp
             slider_notch = self.slider_notch_hyp
             slider_enddiastole = self.slider_enddiastole_hyp
         else:
             raise ValueError(f"Unknown rest_or_hyp value {rest_or_hyp}")
-        ensemble_data, n_rejected = c.ensemble_beats(self, rest_or_hyp)
         plot.clear()
         if ensemble_data:
-            t0 = ensemble_data[0]['time']
-            for beat in ensemble_data:
-                plot.plot(x=t0, y=beat['pa'], pen=(192, 192, 192, 100))
-            mean_pa = c.average_beats_from_beat_list(ensemble_data, measure='pa')
+            t0 = ensemble_data.time
+            for beat in ensemble_data.beats:
+                plot.plot(x=t0, y=beat[CHANNEL_INDEX['pa']], pen=(192, 192, 192, 100))
+            mean_pa = ensemble_data.mean_beat('pa')
             plot.plot(x=t0, y=mean_pa, pen='g', width=100)
-        plot.setTitle(f"Resting Ensemble ({len(ensemble_data)} beats; {n_rejected} rejected)")
+        plot.setTitle(f"Resting Ensemble ({len(ensemble_data)} beats; {ensemble_data.n_rejected} rejected)")
         if slider_notch:
             plot.addItem(slider_notch)
         if slider_enddiastole:
             plot.addItem(slider_enddiastole)
-        return ensemble_data
-
-    def calculate(self):
-        self.calculations['pressures'] = []
-        self.calculations['pressure_ratios'] = []
-        self.calculations['flows'] = []
-        self.calculations['flow_ratios'] = []
-        self.calculations['resistances'] = []
-        if self.ensemble_data_rest:
-            self.calculations['pressures'].append({'name': 'WC Pa',
-                                                   'state': 'rest',
-                                                   'phase': 'mean',
-                                                   'value': c.wholecycle_measure(self, 'rest', 'pa', 'mean')})
-            self.calculations['pressures'].append({'name': 'WC Pd',
-                                                   'state': 'rest',
-                                                   'phase': 'mean',
-                                                   'value': c.wholecycle_measure(self, 'rest', 'pd', 'mean')})
-            self.calculations['pressures'].append({'name': 'WC Pa',
-                                                   'state': 'rest',
-                                                   'phase': 'peak',
-                                                   'value': c.wholecycle_measure(self, 'rest', 'pa', 'peak')})
-            self.calculations['pressures'].append({'name': 'WC Pd',
-                                                   'state': 'rest',
-                                                   'phase': 'peak',
-                                                   'value': c.wholecycle_measure(self, 'rest', 'pd', 'peak')})
-
-            pdpa = c.wholecycle_measure(self, 'rest', 'pd', 'mean') / c.wholecycle_measure(self, 'rest', 'pa', 'mean')
-            self.calculations['pressure_ratios'].append({'name': 'WC PdPa', 'value': pdpa})
-
-            dfr = c.dpr_measure(self, 'rest', 'pd', 'mean') / c.dpr_measure(self, 'rest', 'pa', 'mean')
-            self.calculations['pressure_ratios'].append({'name': 'dPR', 'value': dfr})
-
-            self.calculations['pressure_ratios'].append({'name': 'RFR', 'value': c.rfr(self)})
-
-            self.calculations['flows'].append({'name': 'WC Flow',
-                                               'state': 'rest',
-                                               'phase': 'mean',
-                                               'value': c.wholecycle_measure(self, 'rest', 'flow', 'mean')})
-            self.calculations['flows'].append({'name': 'WC Flow',
-                                               'state': 'rest',
-                                               'phase': 'peak',
-                                               'value': c.wholecycle_measure(self, 'rest', 'flow', 'peak')})
-
-            p_delta = c.wholecycle_measure(self, 'rest', 'pa', 'mean') - c.wholecycle_measure(self, 'rest', 'pd',
-                                                                                              'mean')
-            bsr_mean = p_delta / c.wholecycle_measure(self, 'rest', 'flow', 'mean')
-            bsr_peak = p_delta / c.wholecycle_measure(self, 'rest', 'flow', 'peak')
-            self.calculations['resistances'].append({'name': 'BSR',
-                                                     'phase': 'mean',
-                                                     'value': bsr_mean})
-            self.calculations['resistances'].append({'name': 'BSR',
-                                                     'phase': 'peak',
-                                                     'value': bsr_peak})
-
-            bmr_mean = c.wholecycle_measure(self, 'rest', 'pd', 'mean') / c.wholecycle_measure(self, 'rest', 'flow',
-                                                                                               'mean')
-            bmr_peak = c.wholecycle_measure(self, 'rest', 'pd', 'mean') / c.wholecycle_measure(self, 'rest', 'flow',
-                                                                                               'peak')
-            self.calculations['resistances'].append({'name': 'BMR',
-                                                     'phase': 'mean',
-                                                     'value': bmr_mean})
-            self.calculations['resistances'].append({'name': 'BMR',
-                                                     'phase': 'peak',
-                                                     'value': bmr_peak})
-
-        if self.ensemble_data_hyp:
-            self.calculations['pressures'].append({'name': 'WC Pa',
-                                                   'state': 'hyp',
-                                                   'phase': 'mean',
-                                                   'value': c.wholecycle_measure(self, 'hyp', 'pa', 'mean')})
-            self.calculations['pressures'].append({'name': 'WC Pd',
-                                                   'state': 'hyp',
-                                                   'phase': 'mean',
-                                                   'value': c.wholecycle_measure(self, 'hyp', 'pd', 'mean')})
-            self.calculations['pressures'].append({'name': 'WC Pa',
-                                                   'state': 'hyp',
-                                                   'phase': 'peak',
-                                                   'value': c.wholecycle_measure(self, 'hyp', 'pa', 'peak')})
-            self.calculations['pressures'].append({'name': 'WC Pd',
-                                                   'state': 'hyp',
-                                                   'phase': 'peak',
-                                                   'value': c.wholecycle_measure(self, 'hyp', 'pd', 'peak')})
-
-            ffr = c.wholecycle_measure(self, 'hyp', 'pd', 'mean') / c.wholecycle_measure(self, 'hyp', 'pa', 'mean')
-            self.calculations['pressure_ratios'].append({'name': 'FFR', 'value': ffr})
-
-            self.calculations['flows'].append({'name': 'WC Flow',
-                                               'state': 'hyp',
-                                               'phase': 'mean',
-                                               'value': c.wholecycle_measure(self, 'hyp', 'flow', 'mean')})
-            self.calculations['flows'].append({'name': 'WC Flow',
-                                               'state': 'hyp',
-                                               'phase': 'peak',
-                                               'value': c.wholecycle_measure(self, 'hyp', 'flow', 'peak')})
-
-            p_delta = c.wholecycle_measure(self, 'hyp', 'pa', 'mean') - c.wholecycle_measure(self, 'hyp', 'pd', 'mean')
-            hsr_mean = p_delta / c.wholecycle_measure(self, 'hyp', 'flow', 'mean')
-            hsr_peak = p_delta / c.wholecycle_measure(self, 'hyp', 'flow', 'peak')
-            self.calculations['resistances'].append({'name': 'HSR',
-                                                     'phase': 'mean',
-                                                     'value': hsr_mean})
-            self.calculations['resistances'].append({'name': 'HSR',
-                                                     'phase': 'peak',
-                                                     'value': hsr_peak})
-
-            hmr_mean = c.wholecycle_measure(self, 'hyp', 'pd', 'mean') / c.wholecycle_measure(self, 'hyp', 'flow',
-                                                                                              'mean')
-            hmr_peak = c.wholecycle_measure(self, 'hyp', 'pd', 'mean') / c.wholecycle_measure(self, 'hyp', 'flow',
-                                                                                              'peak')
-            self.calculations['resistances'].append({'name': 'HMR',
-                                                     'phase': 'mean',
-                                                     'value': hmr_mean})
-            self.calculations['resistances'].append({'name': 'HMR',
-                                                     'phase': 'peak',
-                                                     'value': hmr_peak})
-
-        if self.ensemble_data_rest and self.ensemble_data_hyp:
-            cfr_mean = c.wholecycle_measure(self, 'hyp', 'flow', 'mean') / c.wholecycle_measure(self, 'rest', 'flow',
-                                                                                                'mean')
-            cfr_peak = c.wholecycle_measure(self, 'hyp', 'flow', 'peak') / c.wholecycle_measure(self, 'rest', 'flow',
-                                                                                                'peak')
-            self.calculations['flow_ratios'].append({'name': 'CFR',
-                                                     'phase': 'mean',
-                                                     'value': cfr_mean})
-            self.calculations['flow_ratios'].append({'name': 'CFR',
-                                                     'phase': 'peak',
-                                                     'value': cfr_peak})
-
-        if self.slider_group_rest and self.slider_notch_rest and self.slider_enddiastole_rest:
-            self.calculations['pressures'].append({'name': 'Sysolic Pa',
-                                                   'state': 'rest',
-                                                   'phase': 'mean',
-                                                   'value': c.systolic_measure(self, 'rest', 'pa', 'mean')})
-            self.calculations['pressures'].append({'name': 'Sysolic Pd',
-                                                   'state': 'rest',
-                                                   'phase': 'mean',
-                                                   'value': c.systolic_measure(self, 'rest', 'pd', 'mean')})
-            self.calculations['pressures'].append({'name': 'Wavefree Pa',
-                                                   'state': 'rest',
-                                                   'phase': 'mean',
-                                                   'value': c.wavefree_measure(self, 'rest', 'pa', 'mean')})
-            self.calculations['pressures'].append({'name': 'Wavefree Pd',
-                                                   'state': 'rest',
-                                                   'phase': 'mean',
-                                                   'value': c.wavefree_measure(self, 'rest', 'pd', 'mean')})
-            self.calculations['pressures'].append({'name': 'Wavefree Pa',
-                                                   'state': 'rest',
-                                                   'phase': 'peak',
-                                                   'value': c.wavefree_measure(self, 'rest', 'pa', 'peak')})
-            self.calculations['pressures'].append({'name': 'Wavefree Pd',
-                                                   'state': 'rest',
-                                                   'phase': 'peak',
-                                                   'value': c.wavefree_measure(self, 'rest', 'pd', 'peak')})
-
-            ifr = c.wavefree_measure(self, 'rest', 'pd', 'mean') / c.wavefree_measure(self, 'rest', 'pa', 'mean')
-            self.calculations['pressure_ratios'].append({'name': 'iFR', 'value': ifr})
-
-            self.calculations['flows'].append({'name': 'Wavefree flow',
-                                               'state': 'rest',
-                                               'phase': 'mean',
-                                               'value': c.wavefree_measure(self, 'rest', 'flow', 'mean')})
-            self.calculations['flows'].append({'name': 'Wavefree flow',
-                                               'state': 'rest',
-                                               'phase': 'peak',
-                                               'value': c.wavefree_measure(self, 'rest', 'flow', 'peak')})
-
-        if self.slider_group_hyp and self.slider_notch_hyp and self.slider_enddiastole_hyp:
-            self.calculations['pressures'].append({'name': 'Sysolic Pa',
-                                                   'state': 'hyp',
-                                                   'phase': 'mean',
-                                                   'value': c.systolic_measure(self, 'hyp', 'pa', 'mean')})
-            self.calculations['pressures'].append({'name': 'Sysolic Pd',
-                                                   'state': 'hyp',
-                                                   'phase': 'mean',
-                                                   'value': c.systolic_measure(self, 'hyp', 'pd', 'mean')})
-            self.calculations['pressures'].append({'name': 'Wavefree Pa',
-                                                   'state': 'hyp',
-                                                   'phase': 'mean',
-                                                   'value': c.wavefree_measure(self, 'hyp', 'pa', 'mean')})
-            self.calculations['pressures'].append({'name': 'Wavefree Pd',
-                                                   'state': 'hyp',
-                                                   'phase': 'mean',
-                                                   'value': c.wavefree_measure(self, 'hyp', 'pd', 'mean')})
-            self.calculations['pressures'].append({'name': 'Wavefree Pa',
-                                                   'state': 'hyp',
-                                                   'phase': 'peak',
-                                                   'value': c.wavefree_measure(self, 'hyp', 'pa', 'peak')})
-            self.calculations['pressures'].append({'name': 'Wavefree Pd',
-                                                   'state': 'hyp',
-                                                   'phase': 'peak',
-                                                   'value': c.wavefree_measure(self, 'hyp', 'pd', 'peak')})
-
-            ifrh = c.wavefree_measure(self, 'hyp', 'pd', 'mean') / c.wavefree_measure(self, 'hyp', 'pa', 'mean')
-            self.calculations['pressure_ratios'].append({'name': 'iFRa', 'value': ifrh})
-
-            self.calculations['flows'].append({'name': 'Wavefree flow',
-                                               'state': 'hyp',
-                                               'phase': 'mean',
-                                               'value': c.wavefree_measure(self, 'hyp', 'flow', 'mean')})
-            self.calculations['flows'].append({'name': 'Wavefree flow',
-                                               'state': 'hyp',
-                                               'phase': 'peak',
-                                               'value': c.wavefree_measure(self, 'hyp', 'flow', 'peak')})
-
-        if self.slider_group_rest and self.slider_group_hyp and self.slider_notch_rest and self.slider_notch_hyp and \
-                self.slider_enddiastole_rest and self.slider_enddiastole_hyp:
-            sys_cfr_mean = c.systolic_measure(self, 'hyp', 'flow', 'mean') / c.systolic_measure(self, 'rest', 'flow',
-                                                                                                'mean')
-            sys_cfr_peak = c.systolic_measure(self, 'hyp', 'flow', 'peak') / c.systolic_measure(self, 'rest', 'flow',
-                                                                                                'peak')
-            self.calculations['flow_ratios'].append({'name': 'Systolic CFR',
-                                                     'phase': 'mean',
-                                                     'value': sys_cfr_mean})
-            self.calculations['flow_ratios'].append({'name': 'Systolic CFR',
-                                                     'phase': 'peak',
-                                                     'value': sys_cfr_peak})
-
-            wf_cfr_mean = c.wavefree_measure(self, 'hyp', 'flow', 'mean') / c.wavefree_measure(self, 'rest', 'flow',
-                                                                                               'mean')
-            try:
-                wf_cfr_peak = c.wavefree_measure(self, 'hyp', 'flow', 'peak') / c.wavefree_measure(self, 'rest', 'flow',
-                                                                                                   'peak')
-            except ZeroDivisionError:
-                wf_cfr_peak = 0
-            self.calculations['flow_ratios'].append({'name': 'Wavefree CFR',
-                                                     'phase': 'mean',
-                                                     'value': wf_cfr_mean})
-            self.calculations['flow_ratios'].append({'name': 'Wavefree CFR',
-                                                     'phase': 'peak',
-                                                     'value': wf_cfr_peak})
 
     def display_calculations(self):
         tables = [self.tableWidget_Pressures, self.tableWidget_Flows]
@@ -646,7 +521,8 @@ class LabelUI(Ui_MainWindow):
                 table.setItem(i_calc, 0, QtWidgets.QTableWidgetItem(str(calc_dict['name'])))
                 table.setItem(i_calc, 1, QtWidgets.QTableWidgetItem(str(round(calc_dict['value'], 2))))
 
-    def save_cph(self):
+    def current_labels(self):
+        """The label record (see analysis.py) for wherever the sliders currently are"""
         save_dict = {}
         save_dict['pa'] = self.checkBox_Pa.isChecked()
         try:
@@ -673,27 +549,32 @@ class LabelUI(Ui_MainWindow):
             save_dict['enddiastole_hyp'] = self.slider_enddiastole_hyp.value()
         except AttributeError:
             pass
-        with open(f"{self.TxtSdyFile.studypath}.cph", 'wb') as f:
-            pickle.dump(save_dict, f)
+        return save_dict
+
+    def save_labels(self):
+        """Saves now, after any saves already running in the background"""
+        self.save_timer.stop()
+        self.save_pending = False
+        self.savepool.waitForDone()
+        labelstore.save_labels(self.TxtSdyFile.studypath, self.current_labels())
         print("Saved")
 
-    def load_saved_labels(self):
-        cph_path = f"{self.TxtSdyFile.studypath}.cph"
-        saved_cph = self.load_cph(cph_path)
-        pa = saved_cph.get('pa', True)
-        range_rest = saved_cph.get('range_rest', None)
-        range_hyp = saved_cph.get('range_hyp', None)
-        notch_rest = saved_cph.get('notch_rest', None)
-        notch_hyp = saved_cph.get('notch_hyp', None)
-        enddiastole_rest = saved_cph.get('enddiastole_rest', None)
-        enddiastole_hyp = saved_cph.get('enddiastole_hyp', None)
+    def save_labels_async(self):
+        if self.TxtSdyFile:
+            self.savepool.start(LabelSaver(self.TxtSdyFile.studypath, self.current_labels()))
+
+    def load_saved_labels(self, saved_labels=None):
+        if saved_labels is None:
+            saved_labels = labelstore.load_labels(self.TxtSdyFile.studypath)
+        pa = saved_labels.get('pa', True)
+        range_rest = saved_labels.get('range_rest', None)
+        range_hyp = saved_labels.get('range_hyp', None)
+        notch_rest = saved_labels.get('notch_rest', None)
+        notch_hyp = saved_labels.get('notch_hyp', None)
+        enddiastole_rest = saved_labels.get('enddiastole_rest', None)
+        enddiastole_hyp = saved_labels.get('enddiastole_hyp', None)
         self.checkBox_Pa.setChecked(pa)
-        if type(self.TxtSdyFile) == SDYFile:
-            pa_channel = 'pa_physio' if pa else 'pa_trans'
-            if self.TxtSdyFile.pa_channel != pa_channel:
-                self.TxtSdyFile.pa_channel = pa_channel
-                self.TxtSdyFile.parse_data()
-                self.plot_txtsdyFile()
+        # No need to change the SDY Pa channel to match - the loader opens the study with the saved one
         if range_rest:
             self.create_slider_group(rest_or_hyp='rest', range_from=range_rest[0], range_to=range_rest[1])
             self.button_rest.slider_active = True
@@ -719,39 +600,67 @@ class LabelUI(Ui_MainWindow):
             self.button_enddiastole_hyp.slider_active = True
             self.button_enddiastole_hyp.setStyleSheet(f"background-color: 'green'")
 
-    @staticmethod
-    def load_cph(filename):
-        if os.path.exists(filename):
-            with open(filename, 'rb') as f:
-                return pickle.load(f)
-        else:
-            # Save file not found
-            return {}
+    def schedule_calculations(self, save=False):
+        """Coalesces a burst of slider events into one perform_calculations()"""
+        self.save_pending = self.save_pending or save
+        self.calculation_timer.start()  # Restarts it if already waiting
+
+    def scheduled_calculations(self):
+        save, self.save_pending = self.save_pending, False
+        if self.TxtSdyFile:
+            self.perform_calculations(save=save)
 
     def perform_calculations(self, save=False):
-        self.ensemble_data_rest = self.calculate_ensemble(rest_or_hyp='rest')
-        self.ensemble_data_hyp = self.calculate_ensemble(rest_or_hyp='hyp')
-        self.calculate()
+        """Only rebuilds (and redraws) an ensemble if its region has moved; moving a marker just recomputes the measures
+        of that ensemble's marker phases. With save, the labels are saved in the background once they stop changing"""
+        previous = {'rest': self.ensemble_data_rest, 'hyp': self.ensemble_data_hyp}
+        ensembles = analysis.build_ensembles(self.TxtSdyFile, self.current_labels(), previous=previous)
+        self.ensemble_data_rest, self.ensemble_data_hyp = ensembles['rest'], ensembles['hyp']
+        for rest_or_hyp in analysis.STATES:
+            if ensembles[rest_or_hyp] is not previous[rest_or_hyp]:
+                self.plot_ensemble(rest_or_hyp=rest_or_hyp)
+        self.calculations = metrics.evaluate(ensembles)
         self.display_calculations()
         if save:
-            self.save_cph()
+            self.save_timer.start()
 
     def export_study(self):
-        study_dict = {}
-        for table in [self.tableWidget_Pressures, self.tableWidget_PressureRatios, self.tableWidget_Flows, self.tableWidget_FlowRatios, self.tableWidget_Resistances]:
-            for i_row in range(table.rowCount()):
-                dict_key, dict_val = [], None
-                for i_col in range(table.columnCount()):
-                    if i_col != table.columnCount()-1:
-                        dict_key.append(table.item(i_row, i_col).text())
-                    else:
-                        dict_val = table.item(i_row, i_col).text()
-                study_dict["_".join(dict_key)] = dict_val
+        study_dict = analysis.flatten_calculations(self.calculations)
         df = pd.DataFrame([study_dict])
         df.to_csv(self.TxtSdyFile.studypath+".csv")
 
     def export_all(self):
-        print(f"WARNING: Support for exporting all studies in a folder not implemented")
+        if self.studyFolderPath:
+            default_folder = self.studyFolderPath
+        else:
+            default_folder = os.path.dirname(self.TxtSdyFile.studypath) if self.TxtSdyFile else "./data/"
+        folder = QtWidgets.QFileDialog.getExistingDirectory(None, "Select a folder of studies to export",
+                                                            default_folder, QtWidgets.QFileDialog.ShowDirsOnly)
+        if not folder:
+            return
+        out_path, _ = QtWidgets.QFileDialog.getSaveFileName(None, "Export all studies to",
+                                                            os.path.join(folder, "export.csv"),
+                                                            "CSV (*.csv);;Parquet (*.parquet)")
+        if not out_path:
+            return
+
+        self.pushButton_ExportAll.setEnabled(False)  # Until this export is done
+        self.exporter = FolderExporter(folder, out_path)
+        self.exporter.signals.progress.connect(self.on_export_progress)
+        self.exporter.signals.done.connect(lambda n_failed: self.on_export_done(folder, out_path, n_failed))
+        self.exporter.signals.failed.connect(lambda exception: self.on_export_done(folder, out_path, None, exception))
+        self.threadpool.start(self.exporter)
+
+    def on_export_progress(self, n_done, n_total, row):
+        print(f"Exported {n_done}/{n_total}: {row['path']}")
+
+    def on_export_done(self, folder, out_path, n_failed, exception=None):
+        self.exporter = None
+        self.pushButton_ExportAll.setEnabled(True)
+        if exception is not None:
+            print(f"!!!UNABLE TO EXPORT {folder} TO {out_path}: {exception}!!!")
+        else:
+            print(f"Exported {folder} to {out_path} ({n_failed} failed)")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,133 @@
+"""Loads a study off the Qt main thread, so the window stays responsive while big files are parsed.
+
+A StudyLoader first opens the study (with the Pa channel from its saved labels) and builds the level-of-detail pyramids
+of its traces, then emits loaded, so the raw traces can be drawn straight away; it then computes the beat-wise series
+one panel at a time, emitting derived for each. All of these are kept in a StudyCache (see studycache.py), so loading a
+study again only redoes what isn't cached - nothing at all, unless its Pa channel has been swapped. Each load has a
+LoadToken - cancelling it (e.g. when another file is picked) stops the loader at the next step, and the UI ignores
+anything a cancelled loader still emits.
+
+LabelSaver writes a label record in the background; run them on a single-thread pool so saves land in order.
+
+FolderExporter runs a batch export (see batch.py) in the background, reporting each study as it's done."""
+
+import traceback
+
+from PyQt5 import QtCore
+
+from Code.Data import batch, labelstore, lod, plots
+
+
+class LoadToken:
+    def __init__(self, studypath):
+        self.studypath = studypath
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class LoaderSignals(QtCore.QObject):
+    loaded = QtCore.pyqtSignal(object, object, object, object)  # token, study, labels, {channel: EnvelopePyramid}
+    derived = QtCore.pyqtSignal(object, str, object)  # token, panel, {series name: {'x', 'y'}}
+    failed = QtCore.pyqtSignal(object, object)  # token, exception
+    finished = QtCore.pyqtSignal(object)  # token
+
+
+def pressure_ratio_series(study, beats):
+    pdpa = plots.pdpa(study, peaks=study.peaks, beats=beats)
+    return {'pdpa': pdpa, 'pdpa_filtered': plots.pdpa_filtered(pdpa=pdpa)}
+
+
+def resistance_series(study, beats):
+    microvascular = plots.microvascular_resistance(study, peaks=study.peaks, beats=beats)
+    stenosis = plots.stenosis_resistance(study, peaks=study.peaks, beats=beats)
+    return {'microvascular': microvascular,
+            'microvascular_filtered': plots.filtered_resistance(microvascular),
+            'stenosis': stenosis,
+            'stenosis_filtered': plots.filtered_resistance(stenosis)}
+
+
+PANELS = (('pressure_ratios', pressure_ratio_series), ('resistances', resistance_series))
+PLOT_CHANNELS = ('pa', 'pd', 'flow')
+
+
+class StudyLoader(QtCore.QRunnable):
+    def __init__(self, token, study_cache):
+        super(StudyLoader, self).__init__()
+        self.token = token
+        self.study_cache = study_cache
+        self.signals = LoaderSignals()
+
+    def run(self):
+        try:
+            self.load()
+        except Exception as e:  # Don't let it reach sys.excepthook, which would abort the whole app
+            traceback.print_exc()
+            self.signals.failed.emit(self.token, e)
+        finally:
+            self.signals.finished.emit(self.token)
+
+    def load(self):
+        studypath = self.token.studypath
+        labels = labelstore.load_labels(studypath)
+        entry = self.study_cache.open(studypath, labels)
+        with entry.lock:
+            study = entry.study
+            entry.use_labels(labels)
+            missing = [channel for channel in PLOT_CHANNELS if channel not in entry.pyramids]
+            if missing:  # Also decodes the plotted channels here, rather than in the main thread
+                entry.pyramids.update(lod.study_pyramids(study, channels=missing))
+                self.study_cache.resize(studypath)
+            if self.token.cancelled:
+                return
+            self.signals.loaded.emit(self.token, study, labels, dict(entry.pyramids))
+
+            beats = None
+            for panel, series in PANELS:
+                if panel not in entry.derived:
+                    if beats is None:
+                        beats = plots.beatwise(study, peaks=study.peaks)
+                    if self.token.cancelled:
+                        return
+                    entry.derived[panel] = series(study, beats)
+                    self.study_cache.resize(studypath)
+                if self.token.cancelled:
+                    return
+                self.signals.derived.emit(self.token, panel, entry.derived[panel])
+
+
+class LabelSaver(QtCore.QRunnable):
+    def __init__(self, studypath, labels):
+        super(LabelSaver, self).__init__()
+        self.studypath = studypath
+        self.labels = labels
+
+    def run(self):
+        try:
+            labelstore.save_labels(self.studypath, self.labels)
+            print("Saved")
+        except Exception:
+            traceback.print_exc()
+
+
+class ExportSignals(QtCore.QObject):
+    progress = QtCore.pyqtSignal(int, int, object)  # n_done, n_total, row
+    done = QtCore.pyqtSignal(int)  # n_failed
+    failed = QtCore.pyqtSignal(object)  # exception
+
+
+class FolderExporter(QtCore.QRunnable):
+    def __init__(self, folder, out_path):
+        super(FolderExporter, self).__init__()
+        self.folder = folder
+        self.out_path = out_path
+        self.signals = ExportSignals()
+
+    def run(self):
+        try:
+            n_failed = batch.export_folder(self.folder, self.out_path, progress=self.signals.progress.emit)
+            self.signals.done.emit(n_failed)
+        except Exception as e:
+            traceback.print_exc()
+            self.signals.failed.emit(e)
@@ -0,0 +1,50 @@
+import json
+
+import numpy as np
+
+from Code.Data.batch import JsonRowWriter, export_studies
+from Code.Data.labelstore import save_labels
+
+SAMPLE_FREQ = 200
+
+
+def write_txt_study(path, seconds=10, heart_rate=72):
+    """A TXT export as the console writes them - two header lines, a heading, then tab-separated rows"""
+    t = np.arange(seconds * SAMPLE_FREQ) / SAMPLE_FREQ
+    pa = 80 + 40 * np.maximum(np.sin(2 * np.pi * heart_rate / 60 * t), 0) ** 3
+    with open(path, 'w') as f:
+        f.write("Patient: ABC123, Study date: 01/02/2019, Export date: 03/04/2019\n")
+        f.write("Exported by ComboMap\n")
+        f.write("Time\tPa\tPd\tECG\tIPV\tPv\tRWave\tTm\n")
+        for time, p in zip(t, pa):
+            f.write(f"{time:.3f}\t{p:.2f}\t{0.8 * p:.2f}\t0.10\t20.00\t5.0\t\t12:00:00\n")
+
+
+def strict_json(path):
+    def reject(constant):
+        raise ValueError(f"{constant} isn't JSON")
+    with open(path) as f:
+        return json.load(f, parse_constant=reject)
+
+
+def test_json_export_of_a_study_with_no_accepted_beats(tmp_path):
+    studypath = str(tmp_path / 'study.txt')
+    write_txt_study(studypath)
+    save_labels(studypath, {'range_rest': (0.0, 0.2), 'notch_rest': 0.3, 'enddiastole_rest': 0.6})  # Too short for a beat
+    out_path = str(tmp_path / 'out.json')
+
+    assert export_studies([studypath], out_path, workers=1) == 0
+
+    [row] = strict_json(out_path)
+    assert row['error'] == ''
+    assert row['n_labels'] == 3
+    assert row['n_beats_rest'] == 0 and row['n_beats_hyp'] == 0
+
+
+def test_json_writer_writes_non_finite_values_as_null(tmp_path):
+    out_path = str(tmp_path / 'out.json')
+    writer = JsonRowWriter(out_path, ['path', 'BSR_mean', 'BMR_mean', 'iFR', 'error'])
+    writer.write({'path': 'a.txt', 'BSR_mean': float('nan'), 'BMR_mean': np.float64(np.inf), 'iFR': 0.9, 'error': ''})
+    writer.close()
+
+    assert strict_json(out_path) == [{'path': 'a.txt', 'BSR_mean': None, 'BMR_mean': None, 'iFR': 0.9, 'error': ''}]
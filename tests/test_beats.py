@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+from Code.Data.calculations import ensemble_beats
+from Code.Data.peaks import BeatIndex, detect_peaks
+from Code.Data.timeindex import SampleClock
+
+SAMPLE_FREQ = 200
+
+
+def pressure_trace(seconds=200, heart_rate=72, seed=0):
+    rng = np.random.default_rng(seed)
+    t = np.arange(seconds * SAMPLE_FREQ) / SAMPLE_FREQ
+    trace = 80 + 40 * np.maximum(np.sin(2 * np.pi * heart_rate / 60 * t), 0) ** 3 + rng.normal(0, 1, len(t))
+    return trace.astype(np.float32)
+
+
+class ArrayStudy:
+    """Just enough of a study for ensemble_beats()"""
+
+    def __init__(self, pa):
+        self.channels = {'pa': pa, 'pd': pa * 0.8, 'flow': np.ones_like(pa)}
+        self.time = self.time_index = SampleClock(len(pa), SAMPLE_FREQ)
+        self.beat_indexes = {'pa': BeatIndex.from_trace(pa)}
+
+    def channel(self, channel_name):
+        return self.channels[channel_name]
+
+    def beat_index(self, channel_name):
+        return self.beat_indexes[channel_name]
+
+
+@pytest.mark.parametrize('min_dist', [50, 100])
+def test_between_matches_detecting_in_the_region(min_dist):
+    trace = pressure_trace()
+    beat_index = BeatIndex.from_trace(trace, min_dist=min_dist)
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        i_from = int(rng.integers(0, len(trace) - 10))
+        i_to = int(min(len(trace), i_from + rng.integers(3, 6000)))
+        peaks, rr = beat_index.between(i_from, i_to)
+        np.testing.assert_array_equal(peaks, detect_peaks(trace[i_from:i_to], min_dist=min_dist) + i_from)
+        np.testing.assert_array_equal(rr, np.diff(peaks))
+
+
+def test_artefact_outside_region_keeps_its_beats():
+    trace = pressure_trace()
+    with_artefact = trace.copy()
+    with_artefact[30000] = 450  # A flush, well after the region
+    region = (10., 20.)
+
+    beats, n_rejected = ensemble_beats(ArrayStudy(trace), region)
+    beats_artefact, n_rejected_artefact = ensemble_beats(ArrayStudy(with_artefact), region)
+    assert len(beats) == 10
+    np.testing.assert_array_equal(beats_artefact, beats)
+    assert n_rejected_artefact == n_rejected
@@ -0,0 +1,25 @@
+import numpy as np
+
+from Code.Data.lod import EnvelopePyramid
+
+
+def test_view_is_never_bigger_than_the_samples():
+    rng = np.random.default_rng(0)
+    for n in (10, 600, 1000, 4097, 20000):
+        x = np.arange(n) / 200
+        pyramid = EnvelopePyramid(x, rng.normal(size=n))
+        for _ in range(300):
+            x_from, x_to = np.sort(rng.uniform(-1, x[-1] + 1, 2))
+            n_pixels = int(rng.integers(1, 2000))
+            view_x, view_y = pyramid.view(x_from, x_to, n_pixels)
+            n_samples = np.count_nonzero((x >= x_from) & (x <= x_to)) + 2  # The view includes a sample either side
+            assert len(view_x) == len(view_y) <= n_samples
+
+
+def test_view_keeps_the_extremes():
+    rng = np.random.default_rng(1)
+    y = rng.normal(size=100000)
+    pyramid = EnvelopePyramid(np.arange(len(y)), y)
+    view_x, view_y = pyramid.view(0, len(y), 500)
+    assert len(view_y) <= 2 * 500 + 2
+    assert view_y.max() == y.max() and view_y.min() == y.min()